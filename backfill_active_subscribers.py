@@ -0,0 +1,51 @@
+""" One-off Lambda handler to add confirmed subscribers to the active subscribers index """
+
+import os
+
+from utilities import aws_clients
+from utilities.dynamodb_util import (
+    WriteBehindUpdater,
+    active_shard,
+    paginate_dynamodb_response,
+)
+from utilities.log_config import log_invocation, logger
+
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+
+# number of segments the subscribers table scan is split into
+SCAN_SEGMENTS = 4
+
+
+@log_invocation
+def endpoint(event, context):
+    """
+    Set activeShard on every confirmed subscriber that doesn't have it yet.  Safe to
+    run more than once, and while the other functions are live: the update only
+    applies to subscribers who still exist, are confirmed, and haven't been suppressed
+    for bouncing or complaining.
+    """
+    subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
+
+    subscribers = paginate_dynamodb_response(
+        subscribers_table.scan,
+        total_segments=SCAN_SEGMENTS,
+        FilterExpression="subscribedAt > :zero AND attribute_not_exists(activeShard) AND attribute_not_exists(suppressed)",
+        ProjectionExpression="email",
+        ExpressionAttributeValues={":zero": 0},
+    )
+    with WriteBehindUpdater(
+        subscribers_table,
+        UpdateExpression="SET activeShard = :shard",
+        ConditionExpression="attribute_exists(email) AND subscribedAt > :zero AND attribute_not_exists(suppressed)",
+    ) as backfill:
+        for subscriber in subscribers:
+            backfill.add(
+                {"email": subscriber["email"]},
+                ExpressionAttributeValues={
+                    ":shard": active_shard(subscriber["email"]),
+                    ":zero": 0,
+                },
+            )
+
+    logger.info(f"Backfill of active subscribers complete: {backfill.stats=}")
+    return backfill.stats
@@ -0,0 +1,692 @@
+"""
+In-memory stand-ins for the AWS services the mailing list uses, for benchmarks
+
+Each fake implements only the calls and expression syntax that the handlers use, with
+the same request and response shapes as boto3.  Every call is counted in the shared
+ApiCalls counter so a benchmark can report API calls per recipient.
+"""
+
+import bisect
+import collections
+import copy
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, message="", operation="Fake", **extra):
+    return ClientError(
+        {"Error": {"Code": code, "Message": message}, **extra}, operation
+    )
+
+
+class ApiCalls:
+    """Thread-safe counter of calls by service and operation"""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, operation):
+        with self._lock:
+            self.counts[operation] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+# --- DynamoDB expressions ---------------------------------------------------------
+
+_TOKEN = re.compile(
+    r"\s*(?:(<>|<=|>=|=|<|>|\(|\)|,|\+|-)|([#:]?[A-Za-z_][A-Za-z0-9_]*))"
+)
+_COMPARATORS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+_MISSING = object()
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"Can't parse {expression[position:]!r}")
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected and (token or "").upper() != expected:
+            raise ValueError(f"Expected {expected}, got {token!r}")
+        self.position += 1
+        return token
+
+    # Conditions: OR / AND / NOT, comparisons, BETWEEN, and functions
+    def condition(self):
+        node = self.conjunction()
+        while (self.peek() or "").upper() == "OR":
+            self.take()
+            node = ("or", node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while (self.peek() or "").upper() == "AND":
+            self.take()
+            node = ("and", node, self.negation())
+        return node
+
+    def negation(self):
+        if (self.peek() or "").upper() == "NOT":
+            self.take()
+            return ("not", self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        if self.peek() == "(":
+            self.take()
+            node = self.condition()
+            self.take(")")
+            return node
+        token = self.peek()
+        if token in ("attribute_exists", "attribute_not_exists", "begins_with"):
+            self.take()
+            self.take("(")
+            args = [self.operand()]
+            while self.peek() == ",":
+                self.take()
+                args.append(self.operand())
+            self.take(")")
+            return ("function", token, args)
+        left = self.operand()
+        operator = self.take()
+        if operator.upper() == "BETWEEN":
+            low = self.operand()
+            self.take("AND")
+            return ("between", left, low, self.operand())
+        return ("compare", operator, left, self.operand())
+
+    def operand(self):
+        token = self.take()
+        if token.startswith(":"):
+            return ("value", token)
+        return ("path", token)
+
+    # Updates: SET (with + - and if_not_exists), REMOVE and ADD clauses
+    def update(self):
+        actions = []
+        while self.peek():
+            clause = self.take().upper()
+            while True:
+                if clause == "SET":
+                    path = self.operand()
+                    self.take("=")
+                    actions.append(("set", path, self.value_expression()))
+                elif clause == "REMOVE":
+                    actions.append(("remove", self.operand()))
+                elif clause == "ADD":
+                    actions.append(("add", self.operand(), self.operand()))
+                else:
+                    raise ValueError(f"Unsupported update clause {clause}")
+                if self.peek() != ",":
+                    break
+                self.take()
+        return actions
+
+    def value_expression(self):
+        if self.peek() == "if_not_exists":
+            self.take()
+            self.take("(")
+            path = self.operand()
+            self.take(",")
+            default = self.operand()
+            self.take(")")
+            node = ("if_not_exists", path, default)
+        else:
+            node = self.operand()
+        if self.peek() in ("+", "-"):
+            return ("arithmetic", self.take(), node, self.operand())
+        return node
+
+
+@functools.lru_cache(maxsize=None)
+def parse_condition(expression):
+    return _Parser(expression).condition()
+
+
+@functools.lru_cache(maxsize=None)
+def parse_update(expression):
+    return _Parser(expression).update()
+
+
+def _name(path, names):
+    return names.get(path[1], path[1])
+
+
+def _resolve(operand, item, names, values):
+    kind = operand[0]
+    if kind == "value":
+        return values[operand[1]]
+    if kind == "path":
+        return item.get(_name(operand, names), _MISSING)
+    if kind == "if_not_exists":
+        current = item.get(_name(operand[1], names), _MISSING)
+        return (
+            _resolve(operand[2], item, names, values)
+            if current is _MISSING
+            else current
+        )
+    if kind == "arithmetic":
+        left = _resolve(operand[2], item, names, values)
+        right = _resolve(operand[3], item, names, values)
+        return left + right if operand[1] == "+" else left - right
+    raise ValueError(f"Unknown operand {operand}")
+
+
+def evaluate(node, item, names, values):
+    kind = node[0]
+    if kind == "or":
+        return evaluate(node[1], item, names, values) or evaluate(
+            node[2], item, names, values
+        )
+    if kind == "and":
+        return evaluate(node[1], item, names, values) and evaluate(
+            node[2], item, names, values
+        )
+    if kind == "not":
+        return not evaluate(node[1], item, names, values)
+    if kind == "function":
+        function, args = node[1], node[2]
+        value = _resolve(args[0], item, names, values)
+        if function == "attribute_exists":
+            return value is not _MISSING
+        if function == "attribute_not_exists":
+            return value is _MISSING
+        prefix = _resolve(args[1], item, names, values)
+        return isinstance(value, str) and value.startswith(prefix)
+    if kind == "between":
+        value = _resolve(node[1], item, names, values)
+        if value is _MISSING:
+            return False
+        low = _resolve(node[2], item, names, values)
+        return low <= value <= _resolve(node[3], item, names, values)
+    if kind == "compare":
+        left = _resolve(node[2], item, names, values)
+        right = _resolve(node[3], item, names, values)
+        if left is _MISSING or right is _MISSING:
+            # A missing attribute is never equal to, less than or greater than anything
+            return node[1] == "<>"
+        try:
+            return _COMPARATORS[node[1]](left, right)
+        except TypeError:
+            return False
+    raise ValueError(f"Unknown condition {node}")
+
+
+def apply_update(actions, item, names, values):
+    for action in actions:
+        name = _name(action[1], names)
+        if action[0] == "set":
+            item[name] = copy.deepcopy(_resolve(action[2], item, names, values))
+        elif action[0] == "remove":
+            item.pop(name, None)
+        elif action[0] == "add":
+            item[name] = item.get(name, 0) + _resolve(action[2], item, names, values)
+
+
+def project(item, projection, names):
+    if not projection:
+        return dict(item)
+    attributes = [
+        names.get(part.strip(), part.strip()) for part in projection.split(",")
+    ]
+    return {name: item[name] for name in attributes if name in item}
+
+
+# --- DynamoDB tables ----------------------------------------------------------------
+
+
+class FakeTable:
+    """
+    Stand-in for a boto3 DynamoDB Table resource with a hash key, or a (hash key,
+    range key) tuple, and, optionally, global secondary indexes given as
+    {index name: (hash key, range key)}
+    """
+
+    def __init__(self, name, key, api_calls, indexes=None):
+        self.name = name
+        self.key = key
+        self.indexes = indexes or {}
+        self.items = {}
+        self.api_calls = api_calls
+        self._index_cache = {}
+        self._lock = threading.RLock()
+
+    def _key(self, key):
+        if isinstance(self.key, tuple):
+            return tuple(key[name] for name in self.key)
+        return key[self.key]
+
+    def _check(self, item, kwargs, operation):
+        condition = kwargs.get("ConditionExpression")
+        if not condition:
+            return
+        names = kwargs.get("ExpressionAttributeNames", {})
+        values = kwargs.get("ExpressionAttributeValues", {})
+        if not evaluate(parse_condition(condition), item or {}, names, values):
+            extra = {}
+            if item and kwargs.get("ReturnValuesOnConditionCheckFailure") == "ALL_OLD":
+                extra["Item"] = copy.deepcopy(item)
+            raise client_error(
+                "ConditionalCheckFailedException",
+                "The conditional request failed",
+                operation,
+                **extra,
+            )
+
+    def _touch_indexes(self, before, after):
+        for index, (hash_key, _) in self.indexes.items():
+            if (before or {}).get(hash_key) != (after or {}).get(hash_key):
+                self._index_cache.pop(index, None)
+
+    def load(self, items):
+        """Bulk-load items without counting API calls"""
+        with self._lock:
+            for item in items:
+                self.items[self._key(item)] = dict(item)
+            self._index_cache.clear()
+            for index in self.indexes:
+                self._index(index)
+
+    def _index(self, index_name):
+        """
+        :return: dictionary of (items, range keys) sorted by range key, by hash key value
+        """
+        index = self._index_cache.get(index_name)
+        if index is None:
+            hash_key, range_key = self.indexes[index_name]
+            partitions = collections.defaultdict(list)
+            for item in self.items.values():
+                if hash_key in item:
+                    partitions[item[hash_key]].append(item)
+            index = {}
+            for value, partition in partitions.items():
+                partition.sort(key=lambda item: item[range_key])
+                index[value] = (partition, [item[range_key] for item in partition])
+            self._index_cache[index_name] = index
+        return index
+
+    def get_item(self, Key, **kwargs):
+        self.api_calls.add("dynamodb:GetItem")
+        with self._lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            names = kwargs.get("ExpressionAttributeNames", {})
+            return {
+                "Item": copy.deepcopy(
+                    project(item, kwargs.get("ProjectionExpression"), names)
+                )
+            }
+
+    def put_item(self, Item, **kwargs):
+        self.api_calls.add("dynamodb:PutItem")
+        with self._lock:
+            old = self.items.get(self._key(Item))
+            self._check(old, kwargs, "PutItem")
+            self.items[self._key(Item)] = copy.deepcopy(Item)
+            self._touch_indexes(old, Item)
+        return {}
+
+    def update_item(self, Key, **kwargs):
+        self.api_calls.add("dynamodb:UpdateItem")
+        with self._lock:
+            old = self.items.get(self._key(Key))
+            self._check(old, kwargs, "UpdateItem")
+            item = copy.deepcopy(old) if old else dict(Key)
+            apply_update(
+                parse_update(kwargs["UpdateExpression"]),
+                item,
+                kwargs.get("ExpressionAttributeNames", {}),
+                kwargs.get("ExpressionAttributeValues", {}),
+            )
+            self.items[self._key(Key)] = item
+            self._touch_indexes(old, item)
+            returns = kwargs.get("ReturnValues", "NONE")
+        if returns == "ALL_NEW":
+            return {"Attributes": copy.deepcopy(item)}
+        if returns == "ALL_OLD" and old:
+            return {"Attributes": copy.deepcopy(old)}
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self.api_calls.add("dynamodb:DeleteItem")
+        with self._lock:
+            old = self.items.get(self._key(Key))
+            self._check(old, kwargs, "DeleteItem")
+            self.items.pop(self._key(Key), None)
+            self._touch_indexes(old, None)
+        if old and kwargs.get("ReturnValues") == "ALL_OLD":
+            return {"Attributes": copy.deepcopy(old)}
+        return {}
+
+    def _page(self, candidates, kwargs, start_after):
+        limit = kwargs.get("Limit", 1000)
+        names = kwargs.get("ExpressionAttributeNames", {})
+        values = kwargs.get("ExpressionAttributeValues", {})
+        condition = kwargs.get("FilterExpression")
+        node = parse_condition(condition) if condition else None
+        page = candidates[start_after : start_after + limit]
+        items = [
+            project(item, kwargs.get("ProjectionExpression"), names)
+            for item in page
+            if node is None or evaluate(node, item, names, values)
+        ]
+        response = {"Items": items, "Count": len(items), "ScannedCount": len(page)}
+        if start_after + limit < len(candidates):
+            response["LastEvaluatedKey"] = page[-1]
+        return response
+
+    def query(self, IndexName, KeyConditionExpression, **kwargs):
+        self.api_calls.add("dynamodb:Query")
+        hash_key, range_key = self.indexes[IndexName]
+        match = re.fullmatch(r"\s*(\S+)\s*=\s*(:\w+)\s*", KeyConditionExpression)
+        hash_value = kwargs["ExpressionAttributeValues"][match.group(2)]
+        with self._lock:
+            partition, range_keys = self._index(IndexName).get(hash_value, ([], []))
+            start_after = 0
+            if kwargs.get("ExclusiveStartKey"):
+                start_after = bisect.bisect_right(
+                    range_keys, kwargs["ExclusiveStartKey"][range_key]
+                )
+            response = self._page(partition, kwargs, start_after)
+        if "LastEvaluatedKey" in response:
+            last = response["LastEvaluatedKey"]
+            response["LastEvaluatedKey"] = {
+                self.key: last[self.key],
+                hash_key: last[hash_key],
+                range_key: last[range_key],
+            }
+        return response
+
+    def scan(self, **kwargs):
+        self.api_calls.add("dynamodb:Scan")
+        segment = kwargs.get("Segment", 0)
+        total_segments = kwargs.get("TotalSegments", 1)
+        with self._lock:
+            candidates = sorted(
+                (
+                    item
+                    for key, item in self.items.items()
+                    if int(hashlib.md5(str(key).encode()).hexdigest(), 16)
+                    % total_segments
+                    == segment
+                ),
+                key=lambda item: str(item[self.key]),
+            )
+            start_after = 0
+            if kwargs.get("ExclusiveStartKey"):
+                last = str(kwargs["ExclusiveStartKey"][self.key])
+                start_after = next(
+                    (
+                        n
+                        for n, item in enumerate(candidates)
+                        if str(item[self.key]) > last
+                    ),
+                    len(candidates),
+                )
+            response = self._page(candidates, kwargs, start_after)
+        if "LastEvaluatedKey" in response:
+            response["LastEvaluatedKey"] = {
+                self.key: response["LastEvaluatedKey"][self.key]
+            }
+        return response
+
+
+# --- SQS ------------------------------------------------------------------------------
+
+
+class FakeFifoQueue:
+    """
+    Stand-in for an SQS FIFO queue with content-based deduplication, shared by the
+    resource (Queue.send_messages) and client (receive, delete, visibility) interfaces.
+    A message group is locked while any of its messages are in flight.
+    """
+
+    def __init__(self, url, api_calls):
+        self.url = url
+        self.api_calls = api_calls
+        self.groups = collections.OrderedDict()
+        self.in_flight = {}
+        self.sent_bytes = 0
+        self._deduplication = set()
+        self._lock = threading.Lock()
+
+    # boto3 SQS Queue resource
+    def send_messages(self, Entries):
+        self.api_calls.add("sqs:SendMessageBatch")
+        if len(Entries) > 10:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest")
+        if sum(len(entry["MessageBody"].encode()) for entry in Entries) > 256 * 1024:
+            raise client_error("AWS.SimpleQueueService.BatchRequestTooLong")
+        successful = []
+        with self._lock:
+            for entry in Entries:
+                digest = hashlib.sha256(entry["MessageBody"].encode()).hexdigest()
+                if digest not in self._deduplication:
+                    self._deduplication.add(digest)
+                    self.groups.setdefault(
+                        entry["MessageGroupId"], collections.deque()
+                    ).append({"MessageId": digest[:36], "Body": entry["MessageBody"]})
+                    self.sent_bytes += len(entry["MessageBody"].encode())
+                successful.append({"Id": entry["Id"], "MessageId": digest[:36]})
+        return {"Successful": successful, "Failed": []}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(group) for group in self.groups.values()) + len(
+                self.in_flight
+            )
+
+    def _expire(self, now):
+        for handle, (group, message, visible_at) in list(self.in_flight.items()):
+            if visible_at <= now:
+                del self.in_flight[handle]
+                self.groups.setdefault(group, collections.deque()).appendleft(message)
+
+    # boto3 SQS client
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self.api_calls.add("sqs:GetQueueAttributes")
+        return {"Attributes": {"ApproximateNumberOfMessages": str(len(self))}}
+
+    def receive_message(
+        self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, **kwargs
+    ):
+        self.api_calls.add("sqs:ReceiveMessage")
+        now = time.monotonic()
+        messages = []
+        with self._lock:
+            self._expire(now)
+            locked = {group for group, _, _ in self.in_flight.values()}
+            for group, waiting in self.groups.items():
+                if group in locked or not waiting:
+                    continue
+                while waiting and len(messages) < MaxNumberOfMessages:
+                    message = waiting.popleft()
+                    handle = str(uuid.uuid4())
+                    self.in_flight[handle] = (group, message, now + VisibilityTimeout)
+                    messages.append({**message, "ReceiptHandle": handle})
+                break
+            for group in [
+                group for group, waiting in self.groups.items() if not waiting
+            ]:
+                del self.groups[group]
+        return {"Messages": messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.api_calls.add("sqs:DeleteMessageBatch")
+        with self._lock:
+            for entry in Entries:
+                self.in_flight.pop(entry["ReceiptHandle"], None)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.api_calls.add("sqs:ChangeMessageVisibilityBatch")
+        now = time.monotonic()
+        with self._lock:
+            for entry in Entries:
+                if entry["ReceiptHandle"] in self.in_flight:
+                    group, message, _ = self.in_flight[entry["ReceiptHandle"]]
+                    self.in_flight[entry["ReceiptHandle"]] = (
+                        group,
+                        message,
+                        now + entry["VisibilityTimeout"],
+                    )
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+# --- SES, S3 and Lambda ---------------------------------------------------------------
+
+
+class FakeSes:
+    """Stand-in for the boto3 SESv2 client; accepts every email after an optional delay"""
+
+    def __init__(self, api_calls, latency_seconds=0.0, max_send_rate=1_000_000.0):
+        self.api_calls = api_calls
+        self.latency_seconds = latency_seconds
+        self.max_send_rate = max_send_rate
+        self.recipients = collections.Counter()
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def get_account(self):
+        self.api_calls.add("ses:GetAccount")
+        return {
+            "SendQuota": {
+                "Max24HourSend": -1.0,
+                "MaxSendRate": self.max_send_rate,
+                "SentLast24Hours": 0.0,
+            }
+        }
+
+    def send_email(self, Destination, **kwargs):
+        self.api_calls.add("ses:SendEmail")
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            for address in Destination["ToAddresses"]:
+                self.recipients[address] += 1
+        return {"MessageId": str(uuid.uuid4())}
+
+    def create_email_template(self, TemplateName, TemplateContent):
+        self.api_calls.add("ses:CreateEmailTemplate")
+        if TemplateName in self.templates:
+            raise client_error("AlreadyExistsException", "Template already exists.")
+        self.templates[TemplateName] = TemplateContent
+        return {}
+
+    def update_email_template(self, TemplateName, TemplateContent):
+        self.api_calls.add("ses:UpdateEmailTemplate")
+        if TemplateName not in self.templates:
+            raise client_error("NotFoundException", "Template does not exist.")
+        self.templates[TemplateName] = TemplateContent
+        return {}
+
+    def send_bulk_email(self, DefaultContent, BulkEmailEntries, **kwargs):
+        self.api_calls.add("ses:SendBulkEmail")
+        if len(BulkEmailEntries) > 50:
+            raise client_error("BadRequestException", "Too many bulk email entries.")
+        if DefaultContent["Template"]["TemplateName"] not in self.templates:
+            raise client_error("NotFoundException", "Template does not exist.")
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        results = []
+        with self._lock:
+            for entry in BulkEmailEntries:
+                data = json.loads(
+                    entry["ReplacementEmailContent"]["ReplacementTemplate"][
+                        "ReplacementTemplateData"
+                    ]
+                )
+                if not data.get("unsubscribe_url"):
+                    results.append({"Status": "INVALID_PARAMETER", "Error": "No URL"})
+                    continue
+                for address in entry["Destination"]["ToAddresses"]:
+                    self.recipients[address] += 1
+                results.append({"Status": "SUCCESS", "MessageId": str(uuid.uuid4())})
+        return {"BulkEmailEntryResults": results}
+
+
+class FakeS3:
+    """Stand-in for the boto3 S3 client serving objects from a dictionary, with ETags"""
+
+    def __init__(self, api_calls, objects):
+        self.api_calls = api_calls
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.api_calls.add("s3:GetObject")
+        if Key not in self.objects:
+            raise client_error("NoSuchKey", "The specified key does not exist.")
+        body = self.objects[Key].encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if IfNoneMatch == etag:
+            raise client_error("304", "Not Modified", "GetObject")
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.api_calls.add("s3:PutObject")
+        self.objects[Key] = Body.decode() if isinstance(Body, bytes) else Body
+        return {}
+
+
+class FakeLambda:
+    """Stand-in for the boto3 Lambda client; asynchronous invocations are queued"""
+
+    def __init__(self, api_calls):
+        self.api_calls = api_calls
+        self.invocations = collections.deque()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.api_calls.add("lambda:Invoke")
+        self.invocations.append((FunctionName, Payload))
+        return {"StatusCode": 202}
+
+
+class FakeContext:
+    """Lambda context with a generous amount of time remaining"""
+
+    aws_request_id = "benchmark"
+    function_name = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
@@ -0,0 +1,316 @@
+"""
+End-to-end benchmark: create an issue, fan it out to subscribers, and send it
+
+Run from the repository root:
+    python -m benchmarks.fanout_benchmark [--subscribers 1000,10000,100000] [--output FILE]
+
+The handlers run unchanged against the in-memory stand-ins in benchmarks.fakes, which
+take the place of the AWS clients in utilities.aws_clients.  For each list size, each stage reports wall
+time, API calls (in total, by operation and per recipient), peak Python memory from
+tracemalloc (with what is still allocated at the end of the stage, which includes the
+stand-ins' storage), and emails per second.  Results are printed as a table and, with
+--output, written as JSON.  The send rate is set high enough that the numbers measure
+the code rather than the SES quota; use --ses-latency-ms to simulate SES round trips.
+--send-mode bulk sends with SendBulkEmail from an SES template instead of SendEmail.
+"""
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+ISSUE_NUMBER = 100
+# share of the list that signed up but never confirmed, so isn't sent to
+PENDING_SHARE = 0.1
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "BASE_PATH": "",
+    "CREATE_ISSUE_PASSKEY": "benchmark",
+    "LINK_SIGNING_KEY": "benchmark",
+    "TEMPLATE_BUCKET": "benchmark-templates",
+    # The handlers are imported once for all runs, so each run fetches its templates
+    # in the create_issue stage instead
+    "TEMPLATE_PREFETCH": "false",
+    "SUBSCRIBERS_DYNAMODB_TABLE": "benchmark-subscribers",
+    "ISSUES_DYNAMODB_TABLE": "benchmark-issues",
+    "DELIVERIES_DYNAMODB_TABLE": "benchmark-deliveries",
+    "SES_SENDER_IDENTITY_ARN": "arn:aws:ses:us-east-1:000000000000:identity/news@example.org",
+    "SES_CONFIGURATION_SET_ARN": "arn:aws:ses:us-east-1:000000000000:configuration-set/Newsletter",
+    "SES_FIFO_QUEUE": "https://sqs.us-east-1.amazonaws.com/000000000000/benchmark.fifo",
+    "SES_LAMBDA_RUN_TIME_SECONDS": "3600",
+    "SES_SEND_RATE_PER_SECOND": "1000000",
+    "FANOUT_ISSUE_FUNCTION": "benchmark-fanout_issue",
+    # Measure the handlers' work, not writing their logs to the terminal
+    "LOG_LEVEL": "WARNING",
+    "METRICS_ENABLED": "false",
+}
+
+
+def issue_page(content_kb):
+    paragraph = "<p>Thread of the week: <a href='https://example.org/'>link</a> and commentary.</p>\n"
+    return f"""<!DOCTYPE html>
+<html><head><title>Issue {ISSUE_NUMBER}</title></head>
+<body><main class="h-entry">
+<h1>Issue {ISSUE_NUMBER}: Benchmarks</h1>
+<div class="e-content">{paragraph * (content_kb * 1024 // len(paragraph))}</div>
+</main></body></html>"""
+
+
+def subscribers(count, active_shard):
+    for n in range(count):
+        email = f"reader{n}@example.org"
+        subscriber = {"email": email, "id": f"{n:032x}", "createdAt": 0}
+        if n >= count * PENDING_SHARE:
+            subscriber["subscribedAt"] = 1
+            subscriber["activeShard"] = active_shard(email)
+        yield subscriber
+
+
+def megabytes(size):
+    return None if size is None else round(size / 2**20, 2)
+
+
+class Stage:
+    """Measure one stage: wall time, API calls made, and peak traced memory"""
+
+    def __init__(self, api_calls, trace_memory):
+        self.api_calls = api_calls
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        self.calls_before = self.api_calls.snapshot()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.retained_bytes = self.peak_bytes = None
+        if self.trace_memory:
+            self.retained_bytes, self.peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        after = self.api_calls.snapshot()
+        self.calls = {
+            operation: count - self.calls_before.get(operation, 0)
+            for operation, count in sorted(after.items())
+            if count != self.calls_before.get(operation, 0)
+        }
+
+    def result(self, recipients, emails):
+        total_calls = sum(self.calls.values())
+        return {
+            "wallSeconds": round(self.seconds, 4),
+            "apiCalls": total_calls,
+            "apiCallsByOperation": self.calls,
+            "apiCallsPerRecipient": round(total_calls / recipients, 4),
+            "peakMemoryMB": megabytes(self.peak_bytes),
+            # still allocated at the end, mostly messages held by the queue stand-in
+            "retainedMemoryMB": megabytes(self.retained_bytes),
+            "emails": emails,
+            "emailsPerSecond": round(emails / self.seconds, 1) if emails else None,
+        }
+
+
+def run(count, args, template_dir, issue_url):
+    from benchmarks import fakes
+    import create_issue
+    import fanout_issue
+    import send_issue
+    from utilities import aws_clients, dynamodb_util, jinja_renderer
+
+    api_calls = fakes.ApiCalls()
+    issues_table = fakes.FakeTable("issues", "issue_number", api_calls)
+    deliveries_table = fakes.FakeTable(
+        "deliveries", ("issue_number", "email"), api_calls
+    )
+    subscribers_table = fakes.FakeTable(
+        "subscribers",
+        "email",
+        api_calls,
+        indexes={dynamodb_util.ACTIVE_SUBSCRIBERS_INDEX: ("activeShard", "email")},
+    )
+    subscribers_table.load(subscribers(count, dynamodb_util.active_shard))
+    recipients = sum(
+        1 for item in subscribers_table.items.values() if "activeShard" in item
+    )
+    queue = fakes.FakeFifoQueue(os.environ["SES_FIFO_QUEUE"], api_calls)
+    ses = fakes.FakeSes(api_calls, latency_seconds=args.ses_latency_ms / 1000)
+    lambda_client = fakes.FakeLambda(api_calls)
+    with open(os.path.join(template_dir, "sources", "email-template.j2.html")) as f:
+        email_template = f.read()
+    with open(os.path.join("html-templates", jinja_renderer.HTML_PAGE_FILE)) as f:
+        site_wrapper = f.read()
+    s3 = fakes.FakeS3(
+        api_calls,
+        {
+            jinja_renderer.EMAIL_TEMPLATE: email_template,
+            jinja_renderer.HTML_PAGE_FILE: site_wrapper,
+        },
+    )
+
+    # The handlers get their AWS clients from aws_clients, so use the stand-ins there
+    aws_clients.override("table", os.environ["ISSUES_DYNAMODB_TABLE"], issues_table)
+    aws_clients.override(
+        "table", os.environ["DELIVERIES_DYNAMODB_TABLE"], deliveries_table
+    )
+    aws_clients.override(
+        "table", os.environ["SUBSCRIBERS_DYNAMODB_TABLE"], subscribers_table
+    )
+    aws_clients.override("queue", os.environ["SES_FIFO_QUEUE"], queue)
+    aws_clients.override("client", "sqs", queue)
+    aws_clients.override("client", "sesv2", ses)
+    aws_clients.override("client", aws_clients.ISSUE_SENDER, ses)
+    aws_clients.override("client", "lambda", lambda_client)
+    aws_clients.override("client", "s3", s3)
+    send_issue.load_issue_email.cache_clear()
+    # Start each run as a cold container would, without downloaded templates
+    jinja_renderer._template_checked_at.clear()
+    for template in (jinja_renderer.EMAIL_TEMPLATE, jinja_renderer.HTML_PAGE_FILE):
+        for filename in (template, f"{template}.etag"):
+            if os.path.exists(os.path.join(jinja_renderer.TEMPLATE_DIR, filename)):
+                os.remove(os.path.join(jinja_renderer.TEMPLATE_DIR, filename))
+
+    context = fakes.FakeContext()
+    stages = {}
+
+    event = {
+        "body": base64.b64encode(
+            urllib.parse.urlencode(
+                {"passkey": os.environ["CREATE_ISSUE_PASSKEY"], "issue_url": issue_url}
+            ).encode()
+        ).decode(),
+        "isBase64Encoded": True,
+        "requestContext": {"domainName": "example.org"},
+    }
+    with Stage(api_calls, args.memory) as stage:
+        response = create_issue.endpoint(event, context)
+    if response["statusCode"] != 202:
+        raise SystemExit(f"create_issue returned {response['statusCode']}")
+    stages["create_issue"] = stage.result(recipients, 0)
+
+    with Stage(api_calls, args.memory) as stage:
+        while lambda_client.invocations:
+            _, payload = lambda_client.invocations.popleft()
+            fanout_issue.endpoint(json.loads(payload), context)
+    stages["fanout_issue"] = stage.result(recipients, len(queue))
+
+    with Stage(api_calls, args.memory) as stage:
+        send_issue.endpoint({}, context)
+    sent = sum(ses.recipients.values())
+    stages["send_issue"] = stage.result(recipients, sent)
+
+    duplicates = sum(1 for n in ses.recipients.values() if n > 1)
+    if sent != recipients or duplicates or len(queue):
+        raise SystemExit(
+            f"{count} subscribers: sent {sent} of {recipients} ({duplicates} duplicates, {len(queue)} left on the queue)"
+        )
+    return {
+        "subscribers": count,
+        "recipients": recipients,
+        "queueBytes": queue.sent_bytes,
+        "stages": stages,
+        "totalApiCallsPerRecipient": round(
+            sum(api_calls.snapshot().values()) / recipients, 4
+        ),
+    }
+
+
+def print_table(results):
+    print(
+        f"{'subscribers':>11} {'stage':<13} {'seconds':>9} {'calls':>8} {'calls/rcpt':>10} {'peak MB':>8} {'emails/s':>10}"
+    )
+    for result in results:
+        for name, stage in result["stages"].items():
+            peak = (
+                "-" if stage["peakMemoryMB"] is None else f"{stage['peakMemoryMB']:.1f}"
+            )
+            rate = (
+                "-"
+                if stage["emailsPerSecond"] is None
+                else f"{stage['emailsPerSecond']:.0f}"
+            )
+            print(
+                f"{result['subscribers']:>11} {name:<13} {stage['wallSeconds']:>9.3f} {stage['apiCalls']:>8} {stage['apiCallsPerRecipient']:>10.4f} {peak:>8} {rate:>10}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--subscribers",
+        default="1000,10000,100000",
+        help="comma-separated list sizes to run",
+    )
+    parser.add_argument("--content-kb", type=int, default=60)
+    parser.add_argument("--ses-latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip tracemalloc, which slows every stage down",
+    )
+    parser.add_argument(
+        "--send-mode",
+        choices=["single", "bulk"],
+        default="single",
+        help="SES_SEND_MODE: one SendEmail per recipient, or SendBulkEmail",
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    template_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(template_dir, "sources"))
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ["TEMPLATE_DIR"] = template_dir
+    os.environ["SES_SEND_MODE"] = args.send_mode
+
+    from benchmarks.prepared_email import EMAIL_TEMPLATE_SOURCE
+
+    with open(
+        os.path.join(template_dir, "sources", "email-template.j2.html"), "w"
+    ) as f:
+        f.write(EMAIL_TEMPLATE_SOURCE)
+    page_file = os.path.join(
+        template_dir, "sources", f"issue-{ISSUE_NUMBER}-benchmarks"
+    )
+    with open(page_file, "w") as f:
+        f.write(issue_page(args.content_kb))
+    issue_url = f"file://{page_file}"
+
+    results = [
+        run(int(count), args, template_dir, issue_url)
+        for count in args.subscribers.split(",")
+    ]
+    print_table(results)
+
+    if args.output:
+        report = {
+            "benchmark": "fanout",
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "parameters": {
+                "contentKB": args.content_kb,
+                "sesLatencyMs": args.ses_latency_ms,
+                "sendMode": args.send_mode,
+                "traceMemory": args.memory,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Import-time report: how long each Lambda handler module takes to load
+
+Run from the repository root:
+    python -m benchmarks.import_time [--repeat N] [--top K] [--output FILE]
+
+Each handler is imported in a fresh interpreter with `python -X importtime`, as a cold
+Lambda container would, with stand-in environment variables and template prefetch
+turned off so nothing calls AWS.  The report gives the median total import time for
+each handler and the modules it imports directly that take the most of it.  With
+--output, the results are also written as JSON.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.fanout_benchmark import ENVIRONMENT
+
+HANDLERS = [
+    "homepage",
+    "subscribe",
+    "confirm",
+    "unsubscribe",
+    "create_issue",
+    "fanout_issue",
+    "send_issue",
+    "backfill_active_subscribers",
+    "dynamodb_backup",
+]
+
+
+def import_times(module):
+    """
+    :param module: name of the module to import
+
+    :return: dictionary of cumulative import microseconds of the module and of each
+        module it imports directly
+    """
+    environment = {
+        **os.environ,
+        **ENVIRONMENT,
+        "DYNAMODB_BACKUP_RETENTION_DAYS": "7",
+        "TEMPLATE_PREFETCH": "false",
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.rstrip()
+        # Nested imports are indented by two spaces a level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == module or depth == 1:
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=4)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for handler in HANDLERS:
+        runs = [import_times(handler) for _ in range(args.repeat)]
+        packages = {
+            name: statistics.median(run.get(name, 0) for run in runs)
+            for name in runs[0]
+            if name != handler
+        }
+        heaviest = sorted(packages.items(), key=lambda item: -item[1])[: args.top]
+        results.append(
+            {
+                "handler": handler,
+                "importMs": round(
+                    statistics.median(run[handler] for run in runs) / 1000, 1
+                ),
+                "heaviestImportsMs": {
+                    name: round(microseconds / 1000, 1)
+                    for name, microseconds in heaviest
+                },
+            }
+        )
+
+    print(f"{'handler':<28} {'import ms':>9}  heaviest imports (ms)")
+    for result in results:
+        heaviest = ", ".join(
+            f"{name} {ms:.0f}" for name, ms in result["heaviestImportsMs"].items()
+        )
+        print(f"{result['handler']:<28} {result['importMs']:>9.1f}  {heaviest}")
+
+    if args.output:
+        report = {
+            "benchmark": "import_time",
+            "python": sys.version.split()[0],
+            "repeat": args.repeat,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Issue-page parsing: the whole page parsed with html.parser vs. extract_issue
+
+Run from the repository root:
+    python -m benchmarks.ingest_issue [--sizes 100,1000,4000] [--repeat N] [--output FILE]
+
+For each size, a blog page of roughly that many KB is generated: an issue of that
+size inside <main class="h-entry">, surrounded by the navigation, sidebar and footer
+a real blog page has.  The page is parsed the way create_issue used to (a full tree
+with html.parser, then find) and with extract_issue (only the container is parsed,
+with lxml when it is installed).  Both must give the same title and content.  With
+--output, the results are also written as JSON.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from utilities import issue_ingest
+
+ISSUE_TITLE = "Issue 100: Benchmarks"
+
+PARAGRAPH = (
+    "<p>Libraries and <a href='https://example.org/{n}'>link {n}</a> with "
+    "<em>emphasis</em>, <strong>weight</strong> and <code>code</code>.</p>\n"
+)
+SIDEBAR_ENTRY = (
+    "<li class='archive-entry'><a href='https://example.org/archive/{n}'>"
+    "Earlier post {n}</a> <span class='date'>2021-01-01</span></li>\n"
+)
+
+
+def issue_page(kilobytes):
+    """
+    :param kilobytes: approximate size of the page
+
+    :return: HTML of a blog page with about half of its size in the issue content
+    """
+    half = kilobytes * 1024 // 2
+    content = []
+    chrome = []
+    n = 0
+    while sum(map(len, content)) < half:
+        content.append(PARAGRAPH.format(n=n))
+        chrome.append(SIDEBAR_ENTRY.format(n=n))
+        n += 1
+    return (
+        "<!DOCTYPE html><html><head><title>Blog</title>"
+        "<script>var analytics = {};</script></head><body>"
+        "<nav><ul>" + "".join(chrome[: n // 2]) + "</ul></nav>"
+        "<main class='h-entry'><article>"
+        f"<h1 class='p-name'>{ISSUE_TITLE}</h1>"
+        "<div class='e-content'>" + "".join(content) + "</div>"
+        "</article></main>"
+        "<aside><ul>" + "".join(chrome[n // 2 :]) + "</ul></aside>"
+        "<footer><p>Footer</p></footer></body></html>"
+    )
+
+
+def full_parse(page_html):
+    """
+    The parse create_issue did before extract_issue
+
+    :param page_html: HTML of the issue's page
+
+    :return: tuple of (title text, content HTML)
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page_html, features="html.parser")
+    main_content = soup.find("main", class_="h-entry")
+    issue_title = main_content.find_next("h1").string.rstrip()
+    issue_content = str(main_content.find_next("div", class_="e-content"))
+    return issue_title, issue_content
+
+
+def median_ms(function, page_html, repeat):
+    """
+    :return: tuple of (median milliseconds, function's result)
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(page_html)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="100,1000,4000", help="page sizes in KB")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for kilobytes in [int(size) for size in args.sizes.split(",")]:
+        page_html = issue_page(kilobytes)
+        before_ms, before = median_ms(full_parse, page_html, args.repeat)
+        after_ms, after = median_ms(issue_ingest.extract_issue, page_html, args.repeat)
+        if before != after:
+            sys.exit(
+                f"extract_issue gave a different issue for the {kilobytes} KB page"
+            )
+        results.append(
+            {
+                "pageKB": round(len(page_html) / 1024),
+                "fullParseMs": round(before_ms, 1),
+                "extractIssueMs": round(after_ms, 1),
+                "speedup": round(before_ms / after_ms, 2),
+            }
+        )
+
+    print(f"extract_issue parser: {issue_ingest._parser()}")
+    print(
+        f"{'page KB':>8} {'full parse ms':>14} {'extract_issue ms':>17} {'speedup':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['pageKB']:>8} {result['fullParseMs']:>14.1f} "
+            f"{result['extractIssueMs']:>17.1f} {result['speedup']:>7.2f}x"
+        )
+
+    if args.output:
+        report = {
+            "benchmark": "ingest_issue",
+            "python": sys.version.split()[0],
+            "parser": issue_ingest._parser(),
+            "repeat": args.repeat,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
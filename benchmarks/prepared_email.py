@@ -0,0 +1,133 @@
+"""
+Micro-benchmark: render the issue email for every recipient vs. render once and substitute
+
+Run from the repository root:
+    python -m benchmarks.prepared_email [--recipients N] [--content-kb K]
+
+A stand-in email template is written to a temporary TEMPLATE_DIR so no S3 access is
+needed.  Every personalized copy is checked against the full render before timing.
+The body's size before and after PreparedEmail.optimize() is reported too, and each
+optimized copy is checked against the optimized full render.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+EMAIL_TEMPLATE_SOURCE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>{{ h1_header }}</title>
+  <style>
+    body { margin: 0; padding: 0; font-family: Georgia, serif; }
+    .preheader { display: none; max-height: 0; overflow: hidden; }
+    .button { background: #0d6efd; color: #ffffff; padding: 10px 20px; }
+  </style>
+</head>
+<body>
+  {% if preheader %}<div class="preheader">{{ preheader }}</div>{% endif %}
+  <table role="presentation" width="100%">
+    <tr>
+      <td>
+        <h1 style="margin: 0 0 10px;">{{ h1_header }}</h1>
+        {% if blog_version_url %}
+        <p style="font-size: smaller"><a href="{{ blog_version_url }}">Read this issue on the web</a></p>
+        {% endif %}
+        {{ body_content }}
+        {% if action_url %}
+        <p><a class="button" href="{{ action_url }}">{{ action_text }}</a></p>
+        {% endif %}
+      </td>
+    </tr>
+    {% if unsubscribe_url %}
+    <tr>
+      <td style="font-size: smaller">
+        <a href="{{ unsubscribe_url }}">Unsubscribe</a> from this newsletter.
+      </td>
+    </tr>
+    {% endif %}
+  </table>
+</body>
+</html>
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--recipients", type=int, default=2000)
+    parser.add_argument("--content-kb", type=int, default=60)
+    args = parser.parse_args()
+
+    template_dir = tempfile.mkdtemp()
+    os.environ["TEMPLATE_DIR"] = template_dir
+    os.environ.setdefault("TEMPLATE_BUCKET", "benchmark-unused")
+    os.environ["TEMPLATE_PREFETCH"] = "false"
+    # Off by default in the deployed functions; measured here
+    os.environ["EMAIL_OPTIMIZE"] = "true"
+
+    from utilities import jinja_renderer
+
+    with open(os.path.join(template_dir, jinja_renderer.EMAIL_TEMPLATE), "w") as f:
+        f.write(EMAIL_TEMPLATE_SOURCE)
+
+    paragraph = "<p>Thread of the week: <a href='https://example.org/'>link</a> and commentary.</p>\n"
+    render_args = {
+        "h1_header": "Issue 100: Benchmarks",
+        "body_content": paragraph * (args.content_kb * 1024 // len(paragraph)),
+        "preheader": "This week's issue of Thursday Threads.",
+        "blog_version_url": "https://dltj.org/article/issue-100-benchmarks/",
+    }
+    unsubscribe_urls = [
+        f"https://example.org/unsubscribe/reader{n}@example.org/{n:08d}"
+        for n in range(args.recipients)
+    ]
+
+    prepared = jinja_renderer.prepare_email_template(**render_args)
+    if not prepared.substitutable:
+        raise SystemExit("Stand-in template isn't substitutable; check the template")
+    for url in unsubscribe_urls:
+        expected = jinja_renderer.email_template(**render_args, unsubscribe_url=url)
+        if prepared.personalize(unsubscribe_url=url) != expected:
+            raise SystemExit(f"Personalized output differs from full render for {url}")
+
+    start = time.perf_counter()
+    for url in unsubscribe_urls:
+        jinja_renderer.email_template(**render_args, unsubscribe_url=url)
+    render_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prepared = jinja_renderer.prepare_email_template(**render_args)
+    for url in unsubscribe_urls:
+        prepared.personalize(unsubscribe_url=url)
+    prepared_seconds = time.perf_counter() - start
+
+    from utilities.email_optimizer import optimize_html
+
+    before = len(prepared.body.encode())
+    start = time.perf_counter()
+    prepared.optimize()
+    optimize_seconds = time.perf_counter() - start
+    after = len(prepared.body.encode())
+    for url in unsubscribe_urls[:10]:
+        expected = optimize_html(
+            jinja_renderer.email_template(**render_args, unsubscribe_url=url)
+        )
+        if prepared.personalize(unsubscribe_url=url) != expected:
+            raise SystemExit(
+                f"Optimized output differs from optimized render for {url}"
+            )
+
+    print(f"{args.recipients} recipients, {before // 1024} KB body")
+    print(f"render per recipient: {render_seconds:8.3f}s")
+    print(f"prepared + substitute: {prepared_seconds:7.3f}s")
+    print(f"speed-up: {render_seconds / prepared_seconds:.1f}x")
+    print(
+        f"optimized body: {before} -> {after} bytes "
+        f"({100 * (before - after) / before:.1f}% smaller, {optimize_seconds:.3f}s once)"
+    )
+
+
+if __name__ == "__main__":
+    main()
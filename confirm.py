@@ -1,63 +1,97 @@
 """ Lambda handler for the subscribe confirmation link """
 
 import os
-import json
 import time
-from utilities.log_config import logger
-from utilities.jinja_renderer import site_wrap, email_template
+from utilities import aws_clients, link_tokens
+from utilities.log_config import log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+from utilities.dynamodb_util import active_shard
+from utilities.jinja_renderer import (
+    EMAIL_TEMPLATE,
+    HTML_PAGE_FILE,
+    email_template,
+    prefetch_templates,
+    site_wrap,
+    static_page,
+)
 from utilities.send_email import send_email
 
-import boto3
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource("dynamodb")
-subscribers_table = dynamodb.Table(os.environ["SUBSCRIBERS_DYNAMODB_TABLE"])
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+prefetch_templates(HTML_PAGE_FILE, EMAIL_TEMPLATE)
 
 BASE_PATH = os.environ["BASE_PATH"]
 
 
+@log_invocation
+@record_metrics
 def endpoint(event, context):
-    logger.info(json.dumps(event))
-
-    if (
-        "pathParameters" in event
-        and "email" in event["pathParameters"]
-        and "identifier" in event["pathParameters"]
-    ):
-        email = event["pathParameters"]["email"]
-        identifier = event["pathParameters"]["identifier"]
-    else:
+    try:
+        email, identifier = link_tokens.link_subscriber(
+            link_tokens.CONFIRM, event.get("pathParameters") or {}
+        )
+    except KeyError:
         logger.error(f"Incorrectly formatted confirmation URL...missing pathParameters")
-        return site_wrap(
+        return static_page(
             title="Incorrectly formatted confirmation URL",
             content="<p>This shouldn't happen.  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
             statusCode=400,
         )
-
-    sub_query = subscribers_table.get_item(Key={"email": email})
-    logger.debug(f"DynamoDB get_item response: {sub_query}")
-    if not sub_query or "Item" not in sub_query:
-        logger.error("DynamoDB did not return the subscriber Item")
-        return site_wrap(
-            title="Subscription database error",
-            content="<p>This shouldn't happen.  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
-            statusCode=500,
+    except link_tokens.LinkTokenError as error:
+        logger.warning(f"Rejected confirmation link: {error}")
+        return static_page(
+            title="Problem with the email confirmation",
+            content="<p>Sorry—that confirmation link is incorrect or has expired.  Please review the link in the email I sent you, or subscribe again for a new one.</p>",
+            statusCode=400,
         )
-    subscriber = sub_query["Item"]
 
-    if identifier != subscriber["id"]:
-        logger.warning(f"Subscriber's identifier didn't match...got {subscriber['id']}")
-        return site_wrap(
+    # One conditional write checks the identifier and confirms the subscriber.  The
+    # activeShard adds them to the index of subscribers that issues are sent to, which
+    # an address suppressed for bounces or complaints must stay out of.
+    subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
+    try:
+        response = subscribers_table.update_item(
+            Key={"email": email},
+            UpdateExpression="SET subscribedAt = :now, activeShard = :shard",
+            ConditionExpression="id = :id AND attribute_not_exists(suppressed)",
+            ExpressionAttributeValues={
+                ":now": int(time.time()),
+                ":shard": active_shard(email),
+                ":id": identifier,
+            },
+            ReturnValues="ALL_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        if "Item" not in error.response:
+            logger.error("DynamoDB did not return the subscriber Item")
+            return static_page(
+                title="Subscription database error",
+                content="<p>This shouldn't happen.  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
+                statusCode=500,
+            )
+        # The error carries the item in DynamoDB's typed form, {"S": "..."}
+        item = error.response["Item"]
+        if "suppressed" in item and item.get("id") in ({"S": identifier}, identifier):
+            logger.warning(f"Confirmation link for suppressed subscriber {email}")
+            return static_page(
+                title="I can't send to that address",
+                content="<p>Email to that address bounced or was reported as unwanted, so I've stopped sending the newsletter to it.  If that was a mistake, please get in touch and I'll sort it out.</p>",
+                statusCode=400,
+            )
+        logger.warning(
+            f"Subscriber's identifier didn't match...got {error.response['Item'].get('id')}"
+        )
+        return static_page(
             title="Problem with the email confirmation",
             content="<p>Sorry—that confirmation link was incorrect.  Please review the link in the email I sent you.</p>",
             statusCode=400,
         )
-
-    subscriber["subscribedAt"] = int(time.time())
-
+    subscriber = response["Attributes"]
     logger.info(f"Confirmed subscriber: {subscriber=}")
-    response = subscribers_table.put_item(Item=subscriber)
-    logger.debug(f"DynamoDB put_item response: {response}")
 
     h1_header = "Thank you for subscribing to DLTJ's Thursday Threads"
     body_content = """
@@ -65,7 +99,7 @@ def endpoint(event, context):
     <p style="margin: 0 0 10px;">If you ever want to unsubscribe, simply follow the unsubscribe link at the bottom of each email.</p>
     """
     base_url = f"https://{event['requestContext']['domainName']}{BASE_PATH}"
-    unsubscribe_url = f"{base_url}/unsubscribe/{email}/{subscriber['id']}"
+    unsubscribe_url = link_tokens.unsubscribe_url(base_url, email, subscriber["id"])
     email_body = email_template(
         h1_header=h1_header,
         body_content=body_content,
@@ -76,14 +110,15 @@ def endpoint(event, context):
     try:
         send_email(email, h1_header, email_body)
     except ClientError as e:
-        logger.error("Could not send email: %", e.response["Error"]["Message"])
+        logger.error("Could not send email: %s", e.response["Error"]["Message"])
         return site_wrap(
             title="Couldn't send message",
             content=f"<p>Well, this isn't good.  I couldn't send an email to {email}.  The error has been logged; please get in touch with me to sort it out.</p>",
             statusCode=500,
         )
 
-    return site_wrap(
+    metrics.count("Confirmations")
+    return static_page(
         title="Subscription confirmed! Welcome to the Newsletter",
         content=f"<p>Thanks for subscribing.</p>",
     )
@@ -1,38 +1,42 @@
 """ Lambda handler set up a new issue to be sent """
 
-import json
 import os
 import re
 import time
-import urllib.error
-import urllib.request
+import uuid
 from base64 import b64decode
 from urllib.parse import parse_qs
 
-import boto3
-from bs4 import BeautifulSoup
-
-from utilities.dynamodb_util import paginate_dynamodb_response
-from utilities.jinja_renderer import email_template, site_wrap
-from utilities.log_config import logger
+from botocore.exceptions import ClientError
+
+from fanout_issue import initial_job_state, job_is_stale, start_job
+from utilities import aws_clients
+from utilities.issue_ingest import IngestError, ingest_issue
+from utilities.issue_storage import offload_email
+from utilities.jinja_renderer import (
+    EMAIL_TEMPLATE,
+    HTML_PAGE_FILE,
+    prefetch_templates,
+    prepare_email_template,
+    site_wrap,
+)
+from utilities.log_config import log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+from utilities.ses_bulk import register_issue_template
 
 BASE_PATH = os.environ["BASE_PATH"]
 CREATE_ISSUE_PASSKEY = os.environ["CREATE_ISSUE_PASSKEY"]
 
-dynamodb = boto3.resource("dynamodb")
-issues_table = dynamodb.Table(os.environ["ISSUES_DYNAMODB_TABLE"])
-subscribers_table = dynamodb.Table(os.environ["SUBSCRIBERS_DYNAMODB_TABLE"])
-
-sqs = boto3.resource("sqs")
-ses_fifo_queue = sqs.Queue(os.environ["SES_FIFO_QUEUE"])
+ISSUES_TABLE = os.environ["ISSUES_DYNAMODB_TABLE"]
 
 ses_sender_identity = os.environ["SES_SENDER_IDENTITY_ARN"].split("/")[-1]
 ses_configuration_set = os.environ["SES_CONFIGURATION_SET_ARN"].split("/")[-1]
+prefetch_templates(HTML_PAGE_FILE, EMAIL_TEMPLATE)
 
 
+@log_invocation
+@record_metrics
 def endpoint(event, context):
-    logger.info(json.dumps(event))
-
     # Did we get POSTed content?
     if "body" in event:
         body = event["body"]
@@ -47,7 +51,7 @@ def endpoint(event, context):
     if "isBase64Encoded" in event and event["isBase64Encoded"]:
         body = b64decode(body)
     body = parse_qs(body.decode())
-    logger.debug(f"Form content: {body=}")
+    logger.debug("Form content: %s", body)
 
     if "passkey" not in body or body["passkey"][0] != CREATE_ISSUE_PASSKEY:
         logger.error("CREATE_ISSUE_PASSKEY not supplied or incorrect")
@@ -72,7 +76,7 @@ def endpoint(event, context):
         issue_url = body["issue_url"]
 
     # Find the issue number embedded in the URL
-    logger.debug(f"Requested {issue_url=}")
+    logger.debug("Requested %s", issue_url)
     issue_regex = re.compile(r"/issue-(\d+)-[^/]+/?$")
     issue_regex_result = issue_regex.search(issue_url)
     if issue_regex_result:
@@ -85,36 +89,14 @@ def endpoint(event, context):
             statusCode=400,
         )
 
-    # Go get the HTML of the issue
+    # Go get the HTML of the issue, and look for the title and the content body
     try:
-        with urllib.request.urlopen(issue_url) as response:
-            page_html = response.read().decode()
-    except urllib.error.URLError as error:
-        logger.error(f"Couldn't retrieve HTML of {issue_url}: {error.reason}")
+        issue_title, issue_content = ingest_issue(issue_url)
+    except IngestError as error:
+        logger.error(error.detail)
         return site_wrap(
-            title="Couldn't retrieve HTML",
-            content=f"<p>Couldn't retrieve HTML of {issue_url}: {error.reason}</p>",
-            statusCode=400,
-        )
-
-    # Look for the H1-tagged title and the content body
-    ## FIXME: This is hard coded
-    soup = BeautifulSoup(page_html, features="html.parser")
-    main_content = soup.find("main", class_="h-entry")
-    issue_title = main_content.find_next("h1").string.rstrip()
-    issue_content = str(main_content.find_next("div", class_="e-content"))
-    if not issue_title:
-        logger.error(f"Couldn't find 'issue_title' from {issue_url}")
-        return site_wrap(
-            title="Couldn't retrieve issue_title",
-            content=f"<p>Couldn't find 'issue_title' from {issue_url}</p>",
-            statusCode=400,
-        )
-    if not issue_content:
-        logger.error(f"Couldn't find 'issue_content' from {issue_url}")
-        return site_wrap(
-            title="Couldn't retrieve issue_content",
-            content=f"<p>Couldn't find 'issue_content' from {issue_url}</p>",
+            title=error.title,
+            content=f"<p>{error.detail}</p>",
             statusCode=400,
         )
     logger.info(f"Got issue {issue_number} on '{issue_title}'")
@@ -127,9 +109,34 @@ def endpoint(event, context):
     )
 
     # Have we sent this issue already?
-    issue = issues_table.get_item(Key={"issue_number": issue_number})
-    logger.debug(f"DynamoDB get_item response: {issue}")
+    issues_table = aws_clients.table(ISSUES_TABLE)
+    issue = issues_table.get_item(
+        Key={"issue_number": issue_number},
+        ProjectionExpression="issue_number, subject, sentStarting, fanoutJobId, fanoutStatus, fanoutUpdatedAt",
+    )
+    logger.debug("DynamoDB get_item response: %s", issue)
     if issue and "Item" in issue:
+        # An unfinished fan-out that has stopped is picked up again from its last
+        # checkpoint; one still checkpointing is left to finish
+        if (
+            "fanoutJobId" in issue["Item"]
+            and issue["Item"]["fanoutStatus"] != "complete"
+        ):
+            job_id = issue["Item"]["fanoutJobId"]
+            if not job_is_stale(issue["Item"]):
+                logger.info(f"Fan-out job {job_id} for issue {issue_number} is running")
+                return site_wrap(
+                    title=f"Still sending Issue #{issue_number}",
+                    content=f"<p>Fan-out job <code>{job_id}</code> is still running.  If it stops, POST the issue again to resume it.</p>",
+                    statusCode=409,
+                )
+            logger.info(f"Resuming fan-out job {job_id} for issue {issue_number}")
+            start_job(issue_number, job_id)
+            return site_wrap(
+                title=f"Resumed sending Issue #{issue_number}",
+                content=f"<p>Fan-out job <code>{job_id}</code> is continuing from its last checkpoint.</p>",
+                statusCode=202,
+            )
         logger.error(f"Issue already found: {issue['Item']=}")
         return site_wrap(
             title="Issue already found in the database",
@@ -137,57 +144,76 @@ def endpoint(event, context):
             statusCode=500,
         )
 
-    # Store metadata for this issue
+    h1_header = issue_title
+    base_url = f"https://{event['requestContext']['domainName']}{BASE_PATH}"
+    # Render and shrink the parts of the email common to all subscribers just once
+    with metrics.timer("PrepareEmail"):
+        prepared_email = prepare_email_template(
+            h1_header=h1_header,
+            body_content=issue_content,
+            preheader="This week's issue of Thursday Threads.",
+            blog_version_url=issue_url,
+        )
+        prepared_email.optimize()
+
+    # Store metadata for this issue, along with the email that the sender personalizes
+    # and the state of the job that enqueues it for each subscriber
+    job_id = str(uuid.uuid4())
     issue_row = {
         "issue_number": issue_number,
         "subject": issue_title,
         "sentStarting": int(time.time()),
         "subscribers": "0",
+        **initial_job_state(job_id),
     }
     logger.info(f"New issue: {issue_row=}")
+    subject = f"DLTJ Thursday Threads: {issue_title}"
+    issue_row["email"] = {
+        "subject": subject,
+        "fromEmailAddress": ses_sender_identity,
+        "configurationSet": ses_configuration_set,
+        "baseUrl": base_url,
+        **prepared_email.to_item(),
+    }
+    # In bulk mode the senders send the issue from an SES template; without one they
+    # send it one email at a time
+    try:
+        template = register_issue_template(issue_number, subject, prepared_email)
+    except ClientError as error:
+        logger.warning(
+            f"Couldn't register the SES template, sending one at a time: {error.response['Error']['Message']}"
+        )
+        template = None
+    if template:
+        issue_row["email"]["templateName"] = template
+    try:
+        offload_email(issue_number, issue_row)
+    except ClientError as error:
+        logger.error(
+            f"Couldn't store the issue email: {error.response['Error']['Message']}"
+        )
+        return site_wrap(
+            title="Couldn't store the issue",
+            content=f"<p>Issue {issue_number}'s email is too large for the database, and it couldn't be stored in the template bucket.  POST it again to retry.</p>",
+            statusCode=500,
+        )
     response = issues_table.put_item(Item=issue_row)
-    logger.debug(f"DynamoDB put_item response: {response}")
-
-    h1_header = issue_title
-    base_url = f"https://{event['requestContext']['domainName']}{BASE_PATH}"
-
-    # Loop through subscribers
-    for subscriber in paginate_dynamodb_response(subscribers_table.scan):
-        logger.debug(f"Checking subscriber {subscriber=}")
-        if (
-            "subscribedAt" in subscriber
-            and subscriber["subscribedAt"] > 0
-            and subscriber["lastIssueSent"] != issue_number
-        ):
-            unsubscribe_url = (
-                f"{base_url}/unsubscribe/{subscriber['email']}/{subscriber['id']}"
-            )
-            email_body = email_template(
-                h1_header=h1_header,
-                body_content=issue_content,
-                preheader="This week's issue of Thursday Threads.",
-                blog_version_url=issue_url,
-                unsubscribe_url=unsubscribe_url,
-            )
-
-            email_params = {
-                "ConfigurationSetName": ses_configuration_set,
-                "Destination": subscriber["email"],
-                "FromEmailAddress": ses_sender_identity,
-                "Subject": f"DLTJ Thursday Threads: {issue_title}",
-                "Body": email_body,
-            }
-            response = ses_fifo_queue.send_message(
-                MessageBody=json.dumps(email_params), MessageGroupId=str(issue_number)
-            )
-            logger.debug(f"Send email_params to queue: {response=}")
+    logger.debug("DynamoDB put_item response: %s", response)
 
-            subscriber["lastIssueSent"] = issue_number
-            response = subscribers_table.put_item(Item=subscriber)
-            logger.debug(f"Updated subscriber: {response=}")
+    try:
+        start_job(issue_number, job_id)
+    except ClientError as error:
+        logger.error(
+            f"Couldn't start fan-out job: {error.response['Error']['Message']}"
+        )
+        return site_wrap(
+            title="Couldn't start sending the issue",
+            content=f"<p>Issue {issue_number} was saved, but the job to send it didn't start.  POST it again to retry.</p>",
+            statusCode=500,
+        )
 
     return site_wrap(
-        title=f"Got content for Issue #{issue_number}: {issue_title}",
-        content=f"<p>The content you are looking for is {issue_content}.</p>",
-        statusCode=200,
+        title=f"Sending Issue #{issue_number}: {issue_title}",
+        content=f"<p>Fan-out job <code>{job_id}</code> is enqueuing the issue for subscribers.</p><p>The content you are looking for is {issue_content}.</p>",
+        statusCode=202,
     )
@@ -7,13 +7,10 @@ Code based on work by Masudur Rahaman Sayem, solutions architect at Amazon Web S
 """
 
 import os
-import json
 from datetime import datetime, timedelta
-import boto3
 from botocore.exceptions import ClientError
-from utilities.log_config import logger
-
-ddb = boto3.client("dynamodb")
+from utilities import aws_clients
+from utilities.log_config import log_invocation, logger
 
 ddb_tables = [
     os.environ["ISSUES_DYNAMODB_TABLE"].split("/")[-1],
@@ -23,8 +20,9 @@ days_to_look_backup = int(os.environ["DYNAMODB_BACKUP_RETENTION_DAYS"])
 backup_name = "Automated serverless-mailing-list backup"
 
 
+@log_invocation
 def endpoint(event, context):
-    logger.info(json.dumps(event))
+    ddb = aws_clients.client("dynamodb")
 
     for table in ddb_tables:
         try:
@@ -48,7 +46,7 @@ def endpoint(event, context):
             logger.info(f"Total backup count in recent days: {latest_backup_count}")
 
             delete_upper_date = datetime.now() - timedelta(days=days_to_look_backup + 1)
-            logger.debug(f"{delete_upper_date=}")
+            logger.debug("delete_upper_date=%s", delete_upper_date)
             # TimeRangeLowerBound is the release of Amazon DynamoDB Backup and Restore - Nov 29, 2017
             response = ddb.list_backups(
                 TableName=table,
@@ -0,0 +1,228 @@
+""" Lambda handler that enqueues an issue's emails to subscribers as a background job """
+
+import concurrent.futures
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from utilities import aws_clients
+from utilities.dynamodb_util import (
+    ACTIVE_SUBSCRIBER_SHARDS,
+    WriteBehindUpdater,
+    query_active_subscribers_page,
+)
+from utilities.log_config import SAMPLED, log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+from utilities.sqs_util import send_message_batches
+
+ISSUES_TABLE = os.environ["ISSUES_DYNAMODB_TABLE"]
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+SES_FIFO_QUEUE = os.environ["SES_FIFO_QUEUE"]
+FANOUT_ISSUE_FUNCTION = os.environ["FANOUT_ISSUE_FUNCTION"]
+
+# number of SendMessageBatch requests in flight at once
+SQS_PARALLEL_BATCHES = 4
+# subscribers read from each index shard per chunk
+CHUNK_PAGE_SIZE = 100
+# don't start a chunk with less than this much of the invocation left
+CHUNK_TIME_RESERVE_MILLIS = 60 * 1000
+# seconds without a checkpoint after which a job is taken to have stopped; the
+# function's timeout, as no invocation runs longer
+JOB_STALE_SECONDS = 900
+
+
+def start_job(issue_number, job_id):
+    """
+    Start (or continue) the fan-out job for an issue in a new, asynchronous invocation
+    :param issue_number: the issue to send
+    :param job_id: identifier of the job recorded on the issue row
+    """
+    response = aws_clients.client("lambda").invoke(
+        FunctionName=FANOUT_ISSUE_FUNCTION,
+        InvocationType="Event",
+        Payload=json.dumps({"issue_number": issue_number, "jobId": job_id}),
+    )
+    logger.debug("Lambda invoke response: %s", response)
+
+
+def initial_job_state(job_id):
+    """
+    Attributes for a new issue row that describe a fan-out job not yet started
+    :param job_id: identifier of the job
+    :return: dictionary of issue row attributes
+    """
+    return {
+        "fanoutJobId": job_id,
+        "fanoutStatus": "pending",
+        # Each index shard's LastEvaluatedKey; None before the first page.  Shards
+        # are removed when they have been read to the end.
+        "fanoutCursor": {str(shard): None for shard in range(ACTIVE_SUBSCRIBER_SHARDS)},
+        "fanoutChunk": 0,
+        "fanoutEnqueued": 0,
+        "fanoutRetried": 0,
+        "fanoutDropped": 0,
+    }
+
+
+def job_is_stale(issue):
+    """
+    :param issue: the issue row, with sentStarting and the fan-out job's attributes
+
+    :return: True if the job hasn't checkpointed, or been created, within the time
+        an invocation can run, so nothing is working on it
+    """
+    last_update = issue.get("fanoutUpdatedAt", issue.get("sentStarting", 0))
+    return time.time() - int(last_update) > JOB_STALE_SECONDS
+
+
+def fan_out_chunk(issue_number, cursor):
+    """
+    Read one page of subscribers from each unfinished shard, enqueue their emails,
+    and record the issue as sent on each of them
+    :param issue_number: the issue being sent
+    :param cursor: dictionary of LastEvaluatedKey (or None) by shard
+    :return: tuple of (cursor after this chunk, dictionary of counts)
+    """
+    subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cursor)) as executor:
+        pages = list(
+            executor.map(
+                lambda shard: query_active_subscribers_page(
+                    subscribers_table,
+                    int(shard),
+                    cursor[shard],
+                    Limit=CHUNK_PAGE_SIZE,
+                    FilterExpression="lastIssueSent <> :issue",
+                    ProjectionExpression="email, #id",
+                    ExpressionAttributeNames={"#id": "id"},
+                    ExpressionAttributeValues={":issue": issue_number},
+                ),
+                cursor,
+            )
+        )
+
+    next_cursor = {}
+    entries = []
+    subscriber_keys = {}
+    for shard, (subscribers, last_evaluated_key) in zip(cursor, pages):
+        if last_evaluated_key:
+            next_cursor[shard] = last_evaluated_key
+        for subscriber in subscribers:
+            logger.debug("Enqueuing subscriber %s", subscriber, extra=SAMPLED)
+            # The sender looks up the issue's email; the message only says who gets it
+            email_params = {
+                "issue": issue_number,
+                "to": subscriber["email"],
+                "id": subscriber["id"],
+            }
+            entry_id = str(len(entries))
+            entries.append(
+                {
+                    "Id": entry_id,
+                    "MessageBody": json.dumps(email_params),
+                    # SQS won't hand out more of a FIFO group while some of it is in
+                    # flight, so a group per shard lets the sender work in parallel
+                    "MessageGroupId": f"{issue_number}-{shard}",
+                }
+            )
+            subscriber_keys[entry_id] = {"email": subscriber["email"]}
+
+    enqueued_ids, stats = send_message_batches(
+        aws_clients.queue(SES_FIFO_QUEUE), entries, max_workers=SQS_PARALLEL_BATCHES
+    )
+    metrics.count("EmailsEnqueued", stats["enqueued"])
+
+    # Progress is only recorded on subscribers that still exist, so someone who
+    # unsubscribes during the run isn't recreated.
+    with WriteBehindUpdater(
+        subscribers_table,
+        UpdateExpression="SET lastIssueSent = :issue",
+        ConditionExpression="attribute_exists(email)",
+        ExpressionAttributeValues={":issue": issue_number},
+    ) as progress:
+        for entry_id in enqueued_ids:
+            progress.add(subscriber_keys[entry_id])
+    logger.debug("Chunk of %d subscribers: %s %s", len(entries), stats, progress.stats)
+
+    return next_cursor, stats
+
+
+def save_checkpoint(issue_number, chunk, cursor, stats):
+    """
+    Record a finished chunk on the issue row.  The chunk number acts as a lock: if
+    another invocation has checkpointed in the meantime, this one should stop.
+    :param issue_number: the issue being sent
+    :param chunk: number of chunks checkpointed before this one
+    :param cursor: dictionary of LastEvaluatedKey by shard after this chunk
+    :param stats: dictionary of enqueued/retried/dropped counts for this chunk
+    :return: True if the checkpoint was saved
+    """
+    try:
+        aws_clients.table(ISSUES_TABLE).update_item(
+            Key={"issue_number": issue_number},
+            UpdateExpression="SET fanoutCursor = :cursor, fanoutStatus = :status, fanoutChunk = :next, fanoutUpdatedAt = :now ADD fanoutEnqueued :enqueued, fanoutRetried :retried, fanoutDropped :dropped",
+            ConditionExpression="fanoutChunk = :chunk",
+            ExpressionAttributeValues={
+                ":cursor": cursor,
+                ":status": "running" if cursor else "complete",
+                ":chunk": chunk,
+                ":next": chunk + 1,
+                ":now": int(time.time()),
+                ":enqueued": stats["enqueued"],
+                ":retried": stats["retried"],
+                ":dropped": stats["dropped"],
+            },
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.error(f"Issue {issue_number} chunk {chunk} was already checkpointed")
+            return False
+        raise
+    return True
+
+
+@log_invocation
+@record_metrics
+def endpoint(event, context):
+    """
+    Work through the fan-out of an issue in chunks, checkpointing after each one.  When
+    the invocation runs short of time, the job continues in a new invocation; after a
+    crash, the Lambda retry picks up from the last checkpoint.
+    :param event: dictionary with issue_number and jobId
+    :param context: the context in which the lambda is being run
+    """
+    issue_number = int(event["issue_number"])
+    job_id = event["jobId"]
+
+    response = aws_clients.table(ISSUES_TABLE).get_item(
+        Key={"issue_number": issue_number},
+        ConsistentRead=True,
+        ProjectionExpression="fanoutJobId, fanoutStatus, fanoutCursor, fanoutChunk",
+    )
+    job = response.get("Item")
+    if not job or job.get("fanoutJobId") != job_id:
+        logger.error(f"Fan-out job {job_id} not found on issue {issue_number}: {job=}")
+        return "Job not found"
+    if job["fanoutStatus"] == "complete":
+        logger.info(f"Fan-out job {job_id} for issue {issue_number} already complete")
+        return "Job already complete"
+
+    cursor = job["fanoutCursor"]
+    chunk = int(job["fanoutChunk"])
+    while cursor:
+        if context.get_remaining_time_in_millis() < CHUNK_TIME_RESERVE_MILLIS:
+            logger.info(
+                f"Issue {issue_number} continuing in a new invocation at {chunk=}"
+            )
+            start_job(issue_number, job_id)
+            return "Job continuing"
+
+        cursor, stats = fan_out_chunk(issue_number, cursor)
+        if not save_checkpoint(issue_number, chunk, cursor, stats):
+            return "Job superseded"
+        chunk += 1
+
+    logger.info(f"Issue {issue_number} fan-out complete after {chunk} chunks")
+    return "Job complete"
@@ -1,12 +1,17 @@
 """ Lambda handler for the homepage """
 
-import json
 import os
 
-from utilities.jinja_renderer import site_wrap
-from utilities.log_config import logger
+from utilities.jinja_renderer import (
+    HTML_PAGE_FILE,
+    PAGE_MAX_AGE_SECONDS,
+    prefetch_templates,
+    static_page,
+)
+from utilities.log_config import log_invocation, logger
 
 BASE_PATH = os.environ["BASE_PATH"]
+prefetch_templates(HTML_PAGE_FILE)
 
 subscribe_url = f"{BASE_PATH}/subscribe"
 SIGNUP_FORM = f"""
@@ -26,9 +31,13 @@ SIGNUP_FORM = f"""
 """
 
 
+@log_invocation
 def endpoint(event, context):
-    logger.info(json.dumps(event))
-    response = site_wrap(
-        title="DLTJ's Thursday Threads Newsletter Signup", content=SIGNUP_FORM
+    # Rendered once; browsers and CDNs can reuse it and revalidate with its ETag
+    response = static_page(
+        title="DLTJ's Thursday Threads Newsletter Signup",
+        content=SIGNUP_FORM,
+        event=event,
+        max_age=PAGE_MAX_AGE_SECONDS,
     )
     return response
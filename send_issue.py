@@ -1,29 +1,53 @@
+import concurrent.futures
+import functools
 import json
 import os
 import time
-import traceback
 
-import boto3
 from botocore.exceptions import ClientError
 
-from utilities.log_config import logger
+from utilities import aws_clients, delivery_ledger, link_tokens
+from utilities.issue_storage import load_email
+from utilities.jinja_renderer import PreparedEmail
+from utilities.log_config import SAMPLED, log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+from utilities.ses_bulk import (
+    BULK_MAX_DESTINATIONS,
+    SES_SEND_MODE,
+    account_error,
+    send_bulk,
+)
+from utilities.ses_throughput import SesThroughput
+from utilities.sqs_util import BatchAcknowledger, VisibilityExtender
 
-message_queue = boto3.client("sqs")
-ses = boto3.client("sesv2")
-message_queue_empty = False
+ISSUES_TABLE = os.environ["ISSUES_DYNAMODB_TABLE"]
 
 # set these at environment variables
 QUEUE_URL = os.environ["SES_FIFO_QUEUE"]
 # Time the Lambda will be running before shutting down. (max 5 mins)
 LAMBDA_RUN_TIME = int(os.environ["SES_LAMBDA_RUN_TIME_SECONDS"]) * 1000
-# The time in milliseconds to keep within a second, to ensure SES limitations are not exceeded.
-THRESHOLD = 100
 # charset supported in messages
 CHARSET = "UTF-8"
-# number of process to be invoked concurrently
-PARALLEL_REQUESTS = 4
-# the limitation that SES has on sending multiple emails at once
+# number of SES calls made concurrently
+SES_SEND_WORKERS = int(os.environ.get("SES_SEND_WORKERS", "4"))
+# emails per second to start at; adjusted to the account's quota and throttling
 SES_SEND_RATE = int(os.environ["SES_SEND_RATE_PER_SECOND"])
+# concurrent invocations of the queue-triggered entry point; they split the send rate
+SES_EVENT_CONCURRENCY = int(os.environ.get("SES_EVENT_CONCURRENCY", "2"))
+# seconds a warm queue-triggered container keeps its quota reading and send rate
+QUOTA_REFRESH_SECONDS = 300
+# messages received but not yet sent
+MAX_IN_FLIGHT = SES_SEND_WORKERS + 10
+# seconds a received message stays invisible; extended while the message is in flight
+VISIBILITY_TIMEOUT = 30
+# longest receive long poll that SQS allows; the SQS client's read timeout is longer
+MAX_WAIT_SECONDS = 20
+# outcomes after which the message is deleted from the queue
+DELIVERED = {"sent", "duplicate"}
+
+
+_event_throughput = None
+_event_throughput_created = 0
 
 
 def get_time_millis():
@@ -35,127 +59,448 @@ def get_time_millis():
     return current_time
 
 
-def receive_messages():
+def receive_messages(wait_seconds=MAX_WAIT_SECONDS):
     """
-    This function retrieves messages from SQS
+    This function retrieves messages from SQS, long polling until some are available
+    :param wait_seconds: the longest time to wait for a message
     :return response: dictionary of messages received from SQS
     """
-    response = message_queue.receive_message(
-        QueueUrl=QUEUE_URL,
-        AttributeNames=["SentTimestamp"],
-        MaxNumberOfMessages=10,
-        MessageAttributeNames=["All"],
-        VisibilityTimeout=20,
-        WaitTimeSeconds=0,
-    )
+    with metrics.timer("SqsReceive"):
+        response = aws_clients.client("sqs").receive_message(
+            QueueUrl=QUEUE_URL,
+            AttributeNames=["SentTimestamp"],
+            MaxNumberOfMessages=10,
+            MessageAttributeNames=["All"],
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            WaitTimeSeconds=wait_seconds,
+        )
 
     return response
 
 
+@functools.lru_cache(maxsize=8)
+def load_issue_email(issue_number):
+    """
+    This function retrieves the email stored with an issue.  Results are cached, so a
+    warm sender reads each issue from DynamoDB only once.
+    :param issue_number: the issue the email belongs to
+    :return issue_email: dictionary of email details, with the body as a PreparedEmail
+    """
+    response = aws_clients.table(ISSUES_TABLE).get_item(
+        Key={"issue_number": issue_number}, ConsistentRead=True
+    )
+    if "Item" not in response or "email" not in response["Item"]:
+        raise KeyError(f"No email stored for issue {issue_number}")
+    issue_email = load_email(dict(response["Item"]["email"]))
+    issue_email["prepared"] = PreparedEmail.from_item(issue_email)
+    logger.debug("Loaded email for issue %s", issue_number)
+    return issue_email
+
+
+def unsubscribe_url(issue_email, msg_details):
+    """
+    This function builds a subscriber's unsubscribe link
+    :param issue_email: dictionary of email details stored with the issue
+    :param msg_details: the decoded message body
+    :return: the unsubscribe URL
+    """
+    return link_tokens.unsubscribe_url(
+        issue_email["baseUrl"], msg_details["to"], msg_details["id"]
+    )
+
+
+def bulk_issue(message_body):
+    """
+    This function decides whether a message is sent in a bulk call
+    :param message_body: the body of the message
+    :return issue_number: the issue whose SES template the message is sent from, or
+        None if it is sent on its own
+    """
+    if SES_SEND_MODE != "bulk":
+        return None
+    try:
+        msg_details = json.loads(message_body)
+        if "Body" in msg_details:
+            return None
+        issue_email = load_issue_email(msg_details["issue"])
+    except Exception as error:
+        # Sent on its own, where the error is counted and the message retried
+        logger.warning("Can't send in bulk: %s", error)
+        return None
+    return msg_details["issue"] if "templateName" in issue_email else None
+
+
+def compose_email(msg_details):
+    """
+    This function turns a queue message into the parameters for an SES email
+    :param msg_details: the decoded message body
+    :return email_params: dictionary of FromEmailAddress, Destination, Subject, Body,
+        and ConfigurationSetName
+    """
+    # Messages enqueued before the body was stored with the issue carry it inline
+    if "Body" in msg_details:
+        return {"ConfigurationSetName": "Newsletter", **msg_details}
+
+    issue_email = load_issue_email(msg_details["issue"])
+    return {
+        "ConfigurationSetName": issue_email["configurationSet"],
+        "Destination": msg_details["to"],
+        "FromEmailAddress": issue_email["fromEmailAddress"],
+        "Subject": issue_email["subject"],
+        "Body": issue_email["prepared"].personalize(
+            unsubscribe_url=unsubscribe_url(issue_email, msg_details)
+        ),
+    }
+
+
 def send_email(sqs_msg_body):
     """
     This function will send an email through AWS SWS
     :param text: the message to be sent through SES
     :return response: the response received from SES
     """
-    msg_details = json.loads(sqs_msg_body)
-    logger.debug(f"About to send to {msg_details['Destination']=}")
+    msg_details = compose_email(json.loads(sqs_msg_body))
+    logger.debug("About to send to %s", msg_details["Destination"], extra=SAMPLED)
     try:
-        response = ses.send_email(
-            FromEmailAddress=msg_details["FromEmailAddress"],
-            Destination={"ToAddresses": [msg_details["Destination"]]},
-            Content={
-                "Simple": {
-                    "Subject": {"Data": msg_details["Subject"], "Charset": CHARSET},
-                    "Body": {"Html": {"Data": msg_details["Body"], "Charset": CHARSET}},
+        with metrics.timer("SesSend"):
+            response = aws_clients.client(aws_clients.ISSUE_SENDER).send_email(
+                FromEmailAddress=msg_details["FromEmailAddress"],
+                Destination={"ToAddresses": [msg_details["Destination"]]},
+                Content={
+                    "Simple": {
+                        "Subject": {"Data": msg_details["Subject"], "Charset": CHARSET},
+                        "Body": {
+                            "Html": {"Data": msg_details["Body"], "Charset": CHARSET}
+                        },
+                    },
                 },
-            },
-            ConfigurationSetName="Newsletter",
-        )
+                ConfigurationSetName=msg_details["ConfigurationSetName"],
+            )
     except ClientError as e:
         logger.error(f"Could not send email: {e.response['Error']['Message']}")
-    else:
-        logger.debug(f"Email sent: {response=}")
+        raise
+    logger.debug("Email sent: %s", response, extra=SAMPLED)
     return response
 
 
-def delete_message(receipt_handle):
+def delivery_key(message_body):
     """
-    This function will delete the specified message from SQS
-    :param receipt_handle: this is the handle of the message to be deleted
+    This function finds the ledger entry for a message
+    :param message_body: the body of the message
+    :return: tuple of (issue number, recipient), or None if the message isn't recorded
+        in the delivery ledger
     """
-    message_queue.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=receipt_handle)
-    logger.debug(f"Message deleted: {receipt_handle=}")
+    if not delivery_ledger.enabled():
+        return None
+    msg_details = json.loads(message_body)
+    # Messages enqueued before the body was stored with the issue aren't recorded
+    if "issue" not in msg_details:
+        return None
+    return msg_details["issue"], msg_details["to"]
 
 
-def process_message(messages):
+def process_message(message_body, throughput):
     """
-    This function will process each message using a separate thread
-    :param message: the message object that needs to be processed
+    This function sends the email for one message.  It is the send core shared by the
+    scheduled and queue-triggered entry points, and runs on one of the worker threads.
+    The delivery is claimed in the ledger before SES is called, so a message that
+    comes back after it was sent isn't sent again.  If SES may have accepted the email
+    despite the error (no answer came back), the claim is kept until it times out.
+    :param message_body: the body of the message
+    :param throughput: SesThroughput shared by the workers
+    :return: "sent", "failed", "held" when sending has stopped, "duplicate" when it was
+        sent before, or "busy" when another sender is sending it
     """
-
-    logger.debug(f"Attempting to process {messages=}")
-    for message in messages:
-        try:
-            send_email(message["Body"])
-            delete_message(message["ReceiptHandle"])
-        except Exception as error:
-            tb = traceback.format_exc().replace("\n", "\r")
-            logger.error("Error %s. Traceback: %s", error, tb)
+    delivery = None
+    calling_ses = False
+    try:
+        if not throughput.reserve():
+            metrics.count("EmailsHeld")
+            return "held"
+        key = delivery_key(message_body)
+        if key:
+            claim = delivery_ledger.claim(*key)
+            if claim != delivery_ledger.CLAIMED:
+                throughput.release()
+                return "duplicate" if claim == delivery_ledger.SENT else "busy"
+            delivery = key
+        throughput.bucket.acquire()
+        calling_ses = True
+        send_email(message_body)
+    except Exception as error:
+        throughput.release()
+        if delivery:
+            if calling_ses and delivery_ledger.maybe_sent(error):
+                logger.warning(
+                    f"Email to {delivery[1]} may have been sent; keeping its claim"
+                )
+                metrics.count("UncertainDeliveries")
+            else:
+                delivery_ledger.release(delivery[0], [delivery[1]])
+        if isinstance(error, ClientError):
+            throughput.on_error(error)
+        logger.error("Error %s", error, exc_info=True)
+        metrics.count("EmailsFailed")
+        return "failed"
+    if delivery:
+        delivery_ledger.mark_sent(delivery[0], [delivery[1]])
+    throughput.on_success()
+    metrics.count("EmailsSent")
+    return "sent"
 
 
-def handle_sqs_messages():
+def process_bulk(message_bodies, throughput):
     """
-    This function controls the maximum send rate per second. It is designed to run for
-    approximately one second.
+    This function sends an issue to several messages' recipients in one SES call.  It
+    is the bulk counterpart of process_message; each message gets its own outcome.
+    :param message_bodies: bodies of up to BULK_MAX_DESTINATIONS messages for one issue
+    :param throughput: SesThroughput shared by the workers
+    :return: list of process_message outcomes, in the order of message_bodies
     """
-    start_time = get_time_millis()
-    counter = 0
-
-    # While we haven't overrun our per-second send rate and there is more than one second
-    # left since this function invocation started
-    while counter < SES_SEND_RATE and get_time_millis() - start_time + THRESHOLD < 1000:
-        logger.debug(f"Inside while loop. {counter=}, {start_time=}")
+    count = len(message_bodies)
+    if not throughput.reserve(count):
+        metrics.count("EmailsHeld", count)
+        return ["held"] * count
+    outcomes = [None] * count
+    claimed = []
+    calling_ses = False
+    try:
+        messages = [json.loads(body) for body in message_bodies]
+        issue_number = messages[0]["issue"]
+        if delivery_ledger.enabled():
+            claims = delivery_ledger.claim_many(
+                issue_number, [msg["to"] for msg in messages]
+            )
+            for index, claim in enumerate(claims):
+                if claim == delivery_ledger.CLAIMED:
+                    claimed.append(messages[index]["to"])
+                else:
+                    outcomes[index] = (
+                        "duplicate" if claim == delivery_ledger.SENT else "busy"
+                    )
+        sending = [index for index, outcome in enumerate(outcomes) if outcome is None]
+        results = []
+        if sending:
+            throughput.bucket.acquire(len(sending))
+            issue_email = load_issue_email(issue_number)
+            calling_ses = True
+            results = send_bulk(
+                issue_email,
+                [
+                    (
+                        messages[index]["to"],
+                        unsubscribe_url(issue_email, messages[index]),
+                    )
+                    for index in sending
+                ],
+            )
+    except Exception as error:
+        throughput.release(count)
+        if claimed and calling_ses and delivery_ledger.maybe_sent(error):
+            logger.warning(
+                f"Issue {issue_number} may have been sent to {len(claimed)} recipients; keeping their claims"
+            )
+            metrics.count("UncertainDeliveries", len(claimed))
+        elif claimed:
+            delivery_ledger.release(issue_number, claimed)
+        if isinstance(error, ClientError):
+            throughput.on_error(error)
+        logger.error("Error %s", error, exc_info=True)
+        metrics.count("EmailsFailed", count)
+        return ["failed"] * count
 
-        response = receive_messages()
-        global message_queue_empty
+    delivered = []
+    undelivered = []
+    for index, result in zip(sending, results):
+        msg = messages[index]
+        if result["Status"] == "SUCCESS":
+            logger.debug("Email sent to %s: %s", msg["to"], result, extra=SAMPLED)
+            outcomes[index] = "sent"
+            delivered.append(msg["to"])
+            continue
+        logger.error(
+            f"Could not send email to {msg['to']}: {result['Status']} {result.get('Error')}"
+        )
+        error = account_error(result["Status"])
+        if error:
+            throughput.on_error(error)
+        outcomes[index] = "failed"
+        undelivered.append(msg["to"])
+    if claimed:
+        delivery_ledger.mark_sent(issue_number, delivered)
+        delivery_ledger.release(issue_number, undelivered)
+    sent = len(delivered)
+    throughput.release(count - sent)
+    if sent:
+        throughput.on_success(sent)
+    metrics.count("EmailsSent", sent)
+    metrics.count("EmailsFailed", len(undelivered))
+    return outcomes
 
-        if response.get("Messages") is None:
-            message_queue_empty = True
-            break
 
-        messages = response["Messages"]
-        logger.debug(f"Got {len(messages)} messages")
+def process_received_message(message, throughput, acknowledger, extender):
+    """
+    This function adapts the send core to messages the scheduled run received itself:
+    it acknowledges the message once sent (or found to be sent already) and stops
+    extending its visibility.
+    :param message: the message object from ReceiveMessage
+    :param throughput: SesThroughput shared by the workers
+    :param acknowledger: BatchAcknowledger that deletes sent messages
+    :param extender: VisibilityExtender tracking the message
+    :return: the process_message outcome
+    """
+    try:
+        outcome = process_message(message["Body"], throughput)
+    finally:
+        extender.untrack(message["ReceiptHandle"])
+    if outcome in DELIVERED:
+        acknowledger.ack(message["ReceiptHandle"])
+    return outcome
 
-        if SES_SEND_RATE - counter - len(messages) < 0:
-            logger.debug(f"Processing partial message list: {SES_SEND_RATE - counter}")
-            process_message(messages[: (SES_SEND_RATE - counter)])
-            counter += len(messages)
-        else:
-            logger.debug(f"Processing full SES_SEND_RATE of messages")
-            process_message(messages)
-            counter += len(messages)
 
-    # Sleep any remainder left of one second since the invocation of
-    # this function.
-    run_time = get_time_millis() - start_time
-    if run_time < 1000:
-        logger.debug(f"{1000 - run_time} milliseconds remaining")
-        time.sleep((1000 - run_time) / 1000)
+def process_received_bulk(messages, throughput, acknowledger, extender):
+    """
+    This function is the bulk counterpart of process_received_message: each message
+    that was delivered is acknowledged, and the rest return to the queue.
+    :param messages: message objects from ReceiveMessage, all for one issue
+    :param throughput: SesThroughput shared by the workers
+    :param acknowledger: BatchAcknowledger that deletes sent messages
+    :param extender: VisibilityExtender tracking the messages
+    :return: list of process_message outcomes, one for each message
+    """
+    try:
+        outcomes = process_bulk([message["Body"] for message in messages], throughput)
+    finally:
+        for message in messages:
+            extender.untrack(message["ReceiptHandle"])
+    for message, outcome in zip(messages, outcomes):
+        if outcome in DELIVERED:
+            acknowledger.ack(message["ReceiptHandle"])
+    return outcomes
 
 
 def handle_lambda_process():
     """
-    This function handles the process of Lambda and stops it when needed
+    This function receives messages until the queue is empty or the run time is used
+    up, handing them to a pool of workers that share the SES send rate
+    :return stats: dictionary of counts of emails sent, failed, held, sent before
+        (duplicate) and being sent by another sender (busy), SQS requests, SES
+        throughput, and seconds spent waiting for the send rate
     """
     overall_start = get_time_millis()
+    message_queue = aws_clients.client("sqs")
+    throughput = SesThroughput(
+        aws_clients.client(aws_clients.ISSUE_SENDER), SES_SEND_RATE
+    )
+    acknowledger = BatchAcknowledger(message_queue, QUEUE_URL)
+    stats = {
+        "sent": 0,
+        "failed": 0,
+        "held": 0,
+        "duplicate": 0,
+        "busy": 0,
+        "receiveRequests": 0,
+        "bulkSends": 0,
+    }
+    in_flight = set()
+    # Messages waiting to be sent in bulk, by issue
+    pending = {}
 
-    while (
-        not message_queue_empty and get_time_millis() - overall_start < LAMBDA_RUN_TIME
-    ):
-        handle_sqs_messages()
+    def tally(done):
+        for future in done:
+            outcomes = future.result()
+            for outcome in [outcomes] if isinstance(outcomes, str) else outcomes:
+                stats[outcome] += 1
 
+    def submit_bulk(issue):
+        stats["bulkSends"] += 1
+        in_flight.add(
+            pool.submit(
+                process_received_bulk,
+                pending.pop(issue),
+                throughput,
+                acknowledger,
+                extender,
+            )
+        )
+
+    with VisibilityExtender(
+        message_queue, QUEUE_URL, VISIBILITY_TIMEOUT
+    ) as extender, concurrent.futures.ThreadPoolExecutor(
+        max_workers=SES_SEND_WORKERS
+    ) as pool:
+        while True:
+            remaining_seconds = (
+                LAMBDA_RUN_TIME - get_time_millis() + overall_start
+            ) // 1000
+            if remaining_seconds <= 0 or throughput.stopped:
+                break
+            if len(in_flight) >= MAX_IN_FLIGHT:
+                done, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                tally(done)
+                continue
+
+            # Only wait for new messages when there's nothing else to do, and not at
+            # all while messages are held back to fill a bulk send
+            if pending:
+                wait_seconds = 0
+            elif in_flight:
+                wait_seconds = 1
+            else:
+                wait_seconds = min(MAX_WAIT_SECONDS, remaining_seconds)
+            messages = receive_messages(wait_seconds).get("Messages")
+            stats["receiveRequests"] += 1
+            if not messages:
+                # Nothing more is coming to fill the bulk sends
+                for issue in list(pending):
+                    submit_bulk(issue)
+                # A FIFO message group stays locked until its in-flight messages
+                # are deleted, so finish and acknowledge them before polling again;
+                # the queue is only done when there was nothing left to acknowledge
+                done, in_flight = concurrent.futures.wait(in_flight)
+                tally(done)
+                if not acknowledger.flush() and not done:
+                    break
+                continue
+
+            logger.debug("Got %d messages", len(messages))
+            for message in messages:
+                extender.track(message["ReceiptHandle"])
+                issue = bulk_issue(message["Body"])
+                if issue is not None:
+                    pending.setdefault(issue, []).append(message)
+                    if len(pending[issue]) == BULK_MAX_DESTINATIONS:
+                        submit_bulk(issue)
+                    continue
+                in_flight.add(
+                    pool.submit(
+                        process_received_message,
+                        message,
+                        throughput,
+                        acknowledger,
+                        extender,
+                    )
+                )
 
+        for issue in list(pending):
+            submit_bulk(issue)
+        done, _ = concurrent.futures.wait(in_flight)
+        tally(done)
+    acknowledger.flush()
+
+    stats["deleteRequests"] = acknowledger.stats["requests"]
+    stats["deleteFailures"] = acknowledger.stats["failed"]
+    stats["visibilityExtensions"] = extender.stats["extended"]
+    stats["rateLimitSleepSeconds"] = round(throughput.bucket.slept_seconds, 3)
+    stats["throughput"] = throughput.summary()
+    logger.info(f"Send summary: {stats=}")
+    return stats
+
+
+@log_invocation
+@record_metrics
 def endpoint(event, context):
     """
     This is the handler of the lambda function
@@ -163,7 +508,7 @@ def endpoint(event, context):
     :param context: the context in which the lambda is being run
     :return: the final status of the process
     """
-    response = message_queue.get_queue_attributes(
+    response = aws_clients.client("sqs").get_queue_attributes(
         QueueUrl=QUEUE_URL,
         AttributeNames=["ApproximateNumberOfMessages"],
     )
@@ -175,9 +520,80 @@ def endpoint(event, context):
         raise Exception("Couldn't read queue length")
     if response["Attributes"]["ApproximateNumberOfMessages"] == "0":
         return "Nothing to process"
-    logger.debug(f"{response['Attributes']['ApproximateNumberOfMessages']=}")
-    global message_queue_empty
-    message_queue_empty = False
+    logger.debug(
+        "ApproximateNumberOfMessages=%s",
+        response["Attributes"]["ApproximateNumberOfMessages"],
+    )
     handle_lambda_process()
 
     return "Lambda Process Completed"
+
+
+def get_event_throughput():
+    """
+    This function returns the SesThroughput for the queue-triggered entry point.  It is
+    kept between invocations of a warm container, so the rate it has ramped up to
+    carries over, and re-read from SES every QUOTA_REFRESH_SECONDS.
+    :return throughput: SesThroughput with this container's share of the send rate
+    """
+    global _event_throughput, _event_throughput_created
+    if (
+        _event_throughput is None
+        or time.time() - _event_throughput_created > QUOTA_REFRESH_SECONDS
+    ):
+        _event_throughput = SesThroughput(
+            aws_clients.client(aws_clients.ISSUE_SENDER),
+            SES_SEND_RATE,
+            share=SES_EVENT_CONCURRENCY,
+        )
+        _event_throughput_created = time.time()
+    return _event_throughput
+
+
+@log_invocation
+@record_metrics
+def sqs_endpoint(event, context):
+    """
+    This is the handler of the lambda function when it is triggered by the queue
+    :param event: SQS event with a batch of records
+    :param context: the context in which the lambda is being run
+    :return: the messages to be retried, as a partial batch response
+    """
+    records = event["Records"]
+    throughput = get_event_throughput()
+    single = []
+    bulk = {}
+    for record in records:
+        issue = bulk_issue(record["body"])
+        if issue is None:
+            single.append(record)
+        else:
+            bulk.setdefault(issue, []).append(record)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SES_SEND_WORKERS) as pool:
+        bulk_sends = [
+            (group, pool.submit(process_bulk, [r["body"] for r in group], throughput))
+            for group in bulk.values()
+        ]
+        outcomes = dict(
+            zip(
+                (record["messageId"] for record in single),
+                pool.map(
+                    lambda record: process_message(record["body"], throughput), single
+                ),
+            )
+        )
+        for group, future in bulk_sends:
+            outcomes.update(
+                zip((record["messageId"] for record in group), future.result())
+            )
+
+    # Lambda deletes the rest of the batch; these return to the queue
+    failures = [
+        {"itemIdentifier": record["messageId"]}
+        for record in records
+        if outcomes[record["messageId"]] not in DELIVERED
+    ]
+    logger.info(
+        f"Sent {len(records) - len(failures)} of {len(records)}: {throughput.summary()=}"
+    )
+    return {"batchItemFailures": failures}
@@ -0,0 +1,119 @@
+""" Lambda handler that takes bounced and complaining addresses off the send list """
+
+import json
+import os
+import time
+
+from utilities import aws_clients
+from utilities.dynamodb_util import WriteBehindUpdater
+from utilities.log_config import SAMPLED, log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+
+
+def parse_notification(body):
+    """
+    :param body: body of a SesHealthQueue message: an SNS envelope around the SES
+        notification, or the notification itself with raw message delivery
+    :return: the SES notification, or None if the message isn't one
+    """
+    try:
+        message = json.loads(body)
+        if message.get("Type") == "Notification":
+            message = json.loads(message["Message"])
+    except (ValueError, KeyError, AttributeError):
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def suppressions(notification):
+    """
+    :param notification: SES bounce or complaint notification
+    :return: tuple of (reason, list of addresses to stop sending to); reason is None
+        for notifications that don't call for it, such as transient bounces
+    """
+    # Notifications from identities have notificationType; from configuration set
+    # event destinations, eventType
+    kind = notification.get("notificationType") or notification.get("eventType")
+    if kind == "Bounce":
+        bounce = notification.get("bounce", {})
+        if bounce.get("bounceType") != "Permanent":
+            return None, []
+        recipients = bounce.get("bouncedRecipients", [])
+        reason = "bounce"
+    elif kind == "Complaint":
+        recipients = notification.get("complaint", {}).get("complainedRecipients", [])
+        reason = "complaint"
+    else:
+        return None, []
+
+    # Match the case of the address the email was sent to, which is the table's key
+    sent_to = {
+        address.lower(): address
+        for address in notification.get("mail", {}).get("destination", [])
+    }
+    addresses = [
+        sent_to.get(recipient["emailAddress"].lower(), recipient["emailAddress"])
+        for recipient in recipients
+        if recipient.get("emailAddress")
+    ]
+    return reason, addresses
+
+
+@log_invocation
+@record_metrics
+def endpoint(event, context):
+    """
+    Mark the subscribers in a batch of SES bounce and complaint notifications as
+    suppressed, and take them out of the ActiveSubscribers index so fan-out skips them.
+    Only permanent bounces and complaints count.  Updates are idempotent, so if any of
+    them fails the whole batch is retried.
+    :param event: SQS event with a batch of SesHealthQueue records
+    :param context: the context in which the lambda is being run
+    :return: dictionary of counts of what was pruned
+    """
+    stats = {"notifications": 0, "ignored": 0, "malformed": 0}
+    reasons = {}
+    for record in event["Records"]:
+        notification = parse_notification(record["body"])
+        if notification is None:
+            logger.warning("Not an SES notification: %s", record["body"])
+            stats["malformed"] += 1
+            continue
+        stats["notifications"] += 1
+        reason, addresses = suppressions(notification)
+        if not reason:
+            stats["ignored"] += 1
+            continue
+        for address in addresses:
+            reasons.setdefault(address, reason)
+
+    now = int(time.time())
+    # Only subscribers that still exist; unsubscribed addresses aren't recreated
+    with WriteBehindUpdater(
+        aws_clients.table(SUBSCRIBERS_TABLE),
+        UpdateExpression="SET suppressed = :reason, suppressedAt = :now REMOVE activeShard",
+        ConditionExpression="attribute_exists(email)",
+    ) as updater:
+        for address, reason in reasons.items():
+            logger.debug("Suppressing %s: %s", address, reason, extra=SAMPLED)
+            updater.add(
+                {"email": address},
+                ExpressionAttributeValues={":reason": reason, ":now": now},
+            )
+
+    stats["bouncedAddresses"] = sum(
+        1 for reason in reasons.values() if reason == "bounce"
+    )
+    stats["complainedAddresses"] = len(reasons) - stats["bouncedAddresses"]
+    stats["suppressed"] = updater.stats["updated"]
+    stats["notSubscribed"] = updater.stats["skipped"]
+    stats["failed"] = updater.stats["failed"]
+    metrics.count("BouncedAddresses", stats["bouncedAddresses"])
+    metrics.count("ComplainedAddresses", stats["complainedAddresses"])
+    metrics.count("SubscribersSuppressed", stats["suppressed"])
+    logger.info(f"SES health batch: {stats=}")
+    if stats["failed"]:
+        raise Exception(f"Couldn't suppress {stats['failed']} subscribers")
+    return stats
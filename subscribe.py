@@ -1,32 +1,38 @@
 """ Lambda handler for the subscribe form post """
 
-import json
 import os
 import time
 import uuid
 from base64 import b64decode
 from urllib.parse import parse_qs
 
-import boto3
 from botocore.exceptions import ClientError
 
-from utilities.jinja_renderer import email_template, site_wrap
-from utilities.log_config import logger
+from utilities import aws_clients, link_tokens
+from utilities.jinja_renderer import (
+    EMAIL_TEMPLATE,
+    HTML_PAGE_FILE,
+    email_template,
+    prefetch_templates,
+    site_wrap,
+    static_page,
+)
+from utilities.log_config import log_invocation, logger
+from utilities.metrics import metrics, record_metrics
 from utilities.send_email import send_email
 
 BASE_PATH = os.environ["BASE_PATH"]
-
-dynamodb = boto3.resource("dynamodb")
-subscribers_table = dynamodb.Table(os.environ["SUBSCRIBERS_DYNAMODB_TABLE"])
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+prefetch_templates(HTML_PAGE_FILE, EMAIL_TEMPLATE)
 
 
+@log_invocation
+@record_metrics
 def endpoint(event, context):
-    logger.info(json.dumps(event))
-
     if "body" in event:
         body = event["body"]
     else:
-        return site_wrap(
+        return static_page(
             title="No email address received",
             content="<p>The form submission did not include an email address. Please try again.</p>",
             statusCode=400,
@@ -35,10 +41,10 @@ def endpoint(event, context):
     if "isBase64Encoded" in event and event["isBase64Encoded"]:
         body = b64decode(body)
     body = parse_qs(body.decode())
-    logger.debug(f"Form content: {body=}")
+    logger.debug("Form content: %s", body)
 
     if "subscriber" not in body:
-        return site_wrap(
+        return static_page(
             title="Email address field not received",
             content="<p>The form submission did not include an email address. Please try again.</p>",
             statusCode=400,
@@ -49,23 +55,49 @@ def endpoint(event, context):
     else:
         email = body["subscriber"]
 
-    logger.debug(f"Requested {email=}")
-    subscriber = subscribers_table.get_item(Key={"email": email})
-    logger.debug(f"DynamoDB get_item response: {subscriber}")
-    if subscriber and "Item" in subscriber:
-        logger.info(f"Subscriber found: {subscriber['Item']=}")
-        return site_wrap(
-            title="Hey! I think you are already subscribed!",
-            content=f"<p>I have {email} on the newsletter subscription list already.  If you aren't receiving it, please get in touch so we can sort out the problem.</p>",
-            statusCode=400,
-        )
-
+    logger.debug("Requested %s", email)
     subscriber = {
         "email": email,
         "id": str(uuid.uuid4()),
         "requestedAt": int(time.time()),
         "lastIssueSent": 0,
     }
+    # One conditional write both checks for and records the subscriber.  A request
+    # that was never confirmed is replaced once its confirmation link has expired, so
+    # the person can ask for another; until then the link already sent stands.  A
+    # request whose confirmation email bounced or drew a complaint is never replaced.
+    condition = {"ConditionExpression": "attribute_not_exists(email)"}
+    if link_tokens.confirm_links_expire():
+        condition = {
+            "ConditionExpression": "attribute_not_exists(email) OR (attribute_not_exists(subscribedAt) AND attribute_not_exists(suppressed) AND requestedAt < :expired)",
+            "ExpressionAttributeValues": {
+                ":expired": subscriber["requestedAt"]
+                - link_tokens.CONFIRM_LINK_TTL_SECONDS
+            },
+        }
+    subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
+    try:
+        response = subscribers_table.put_item(
+            Item=subscriber, ReturnValuesOnConditionCheckFailure="ALL_OLD", **condition
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        if "suppressed" in error.response.get("Item", {}):
+            logger.info(f"Subscriber suppressed: {email}")
+            return site_wrap(
+                title="I can't send to that address",
+                content=f"<p>Email to {email} bounced or was reported as unwanted, so I've stopped sending the newsletter to it.  If that was a mistake, please get in touch and I'll sort it out.</p>",
+                statusCode=400,
+            )
+        logger.info(f"Subscriber found: {email}")
+        return site_wrap(
+            title="Hey! I think you are already subscribed!",
+            content=f"<p>I have {email} on the newsletter subscription list already.  If you aren't receiving it, please get in touch so we can sort out the problem.</p>",
+            statusCode=400,
+        )
+    logger.info(f"New subscriber: {subscriber=}")
+    logger.debug("DynamoDB put_item response: %s", response)
 
     h1_header = "Confirm your subscription to DLTJ's Thursday Threads"
     body_content = """
@@ -73,7 +105,7 @@ def endpoint(event, context):
     <p style="margin: 0 0 10px;">If you received this email by mistake, simply delete it with my apologies for the bother.  You won't be subscribed if you don't follow the "Subscribe me" link.  For any questions about this newsletter, simply reply to this email.</p>
     """
     base_url = f"https://{event['requestContext']['domainName']}{BASE_PATH}"
-    confirm_url = f"{base_url}/subscribe/confirm/{email}/{subscriber['id']}"
+    confirm_url = link_tokens.confirm_url(base_url, email, subscriber["id"])
     email_body = email_template(
         h1_header=h1_header,
         body_content=body_content,
@@ -85,17 +117,21 @@ def endpoint(event, context):
     try:
         send_email(email, h1_header, email_body)
     except ClientError as e:
-        logger.error("Could not send email: %", e.response["Error"]["Message"])
+        logger.error("Could not send email: %s", e.response["Error"]["Message"])
+        # Without the confirmation email the request can't be completed, so let it be
+        # made again
+        subscribers_table.delete_item(
+            Key={"email": email},
+            ConditionExpression="id = :id",
+            ExpressionAttributeValues={":id": subscriber["id"]},
+        )
         return site_wrap(
             title="Couldn't send message",
             content=f"<p>Well, this isn't good.  I couldn't send an email to {email}.  The error has been logged; please get in touch with me to sort it out.</p>",
             statusCode=500,
         )
 
-    logger.info(f"New subscriber: {subscriber=}")
-    response = subscribers_table.put_item(Item=subscriber)
-    logger.debug(f"DynamoDB put_item response: {response}")
-
+    metrics.count("SubscribeRequests")
     return site_wrap(
         title="Confirmation email sent",
         content=f"<p>I got your request to subscribe {email}.  Please check your email for a confirmation link.</p>",
@@ -0,0 +1,133 @@
+""" Behavior of the email optimizer: the HTML it writes should render as its input did """
+import unittest
+from unittest import mock
+
+from bs4 import BeautifulSoup
+
+from utilities import email_optimizer
+from utilities.email_optimizer import optimize_html
+
+
+def optimized(html, keep=()):
+    with mock.patch.object(email_optimizer, "EMAIL_OPTIMIZE", True):
+        return optimize_html(html, keep=keep)
+
+
+def style_of(html, selector):
+    """
+    :return: dictionary of the style attribute of the element the selector finds
+    """
+    element = BeautifulSoup(html, features="html.parser").select_one(selector)
+    return dict(
+        declaration.split(":", 1)
+        for declaration in element.get("style", "").split(";")
+        if declaration
+    )
+
+
+def stylesheet(html):
+    style = BeautifulSoup(html, features="html.parser").find("style")
+    return style.string if style else ""
+
+
+class CascadeTest(unittest.TestCase):
+    def test_later_rule_wins(self):
+        html = optimized(
+            "<html><head><style>p{color:red} p{color:blue}</style></head>"
+            "<body><p>x</p></body></html>"
+        )
+        self.assertEqual(style_of(html, "p")["color"], "blue")
+
+    def test_more_specific_rule_wins_regardless_of_order(self):
+        html = optimized(
+            "<html><head><style>p.note{color:red} p{color:blue}</style></head>"
+            "<body><p class=note>x</p></body></html>"
+        )
+        self.assertEqual(style_of(html, "p")["color"], "red")
+
+    def test_style_attribute_wins_over_stylesheet(self):
+        html = optimized(
+            "<html><head><style>#a{color:red}</style></head>"
+            '<body><p id=a style="color:green">x</p></body></html>'
+        )
+        self.assertEqual(style_of(html, "p")["color"], "green")
+
+    def test_important_stylesheet_rule_wins_over_style_attribute(self):
+        html = optimized(
+            "<html><head><style>p{color:red!important}</style></head>"
+            '<body><p style="color:green">x</p></body></html>'
+        )
+        self.assertEqual(style_of(html, "p")["color"], "red!important")
+
+
+class KeptRulesTest(unittest.TestCase):
+    def test_media_rules_stay_and_override_inlined_styles(self):
+        html = optimized(
+            "<html><head><style>td{width:600px}"
+            "@media (max-width:600px){td{width:100%}}</style></head>"
+            "<body><table><tr><td>x</td></tr></table></body></html>"
+        )
+        self.assertEqual(style_of(html, "td")["width"], "600px")
+        self.assertIn(
+            "@media (max-width:600px){td{width:100%!important}}", stylesheet(html)
+        )
+
+    def test_pseudo_class_rules_stay_and_override_inlined_styles(self):
+        html = optimized(
+            "<html><head><style>a{color:blue} a:hover{color:red}</style></head>"
+            '<body><a href="https://example.com/">x</a></body></html>'
+        )
+        self.assertEqual(style_of(html, "a")["color"], "blue")
+        self.assertIn("a:hover{color:red!important}", stylesheet(html))
+
+    def test_font_face_is_kept_unchanged(self):
+        html = optimized(
+            "<html><head><style>@font-face{font-family:X;src:url(x.woff)}</style>"
+            "</head><body><p>x</p></body></html>"
+        )
+        self.assertIn("@font-face{font-family:X;src:url(x.woff)}", stylesheet(html))
+
+
+class CommentsAndWhitespaceTest(unittest.TestCase):
+    def test_conditional_comments_are_kept(self):
+        html = optimized(
+            "<html><body><!--[if mso]><table><tr><td><![endif]-->"
+            "<!-- a note --><p>x</p><!--[if mso]></td></tr></table><![endif]-->"
+            "</body></html>"
+        )
+        self.assertIn("<!--[if mso]><table><tr><td><![endif]-->", html)
+        self.assertIn("<!--[if mso]></td></tr></table><![endif]-->", html)
+        self.assertNotIn("a note", html)
+
+    def test_preformatted_text_is_unchanged(self):
+        html = optimized("<html><body><pre>a\n   b</pre>\n\n<p>c   d</p></body></html>")
+        self.assertIn("<pre>a\n   b</pre>", html)
+        self.assertIn("<p>c d</p>", html)
+
+
+class PlaceholdersTest(unittest.TestCase):
+    def test_placeholders_come_through(self):
+        source = (
+            "<html><head><style>.u{color:gray}</style></head><body>"
+            '<p class=u><a href="@@unsubscribe_url@@">Unsubscribe</a></p></body></html>'
+        )
+        html = optimized(source, keep=["@@unsubscribe_url@@"])
+        self.assertNotEqual(html, source)
+        self.assertEqual(html.count("@@unsubscribe_url@@"), 1)
+
+    def test_html_is_unchanged_if_a_placeholder_is_lost(self):
+        source = "<html><body><!-- @@unsubscribe_url@@ --><p>x</p></body></html>"
+        self.assertEqual(optimized(source, keep=["@@unsubscribe_url@@"]), source)
+
+
+class SwitchTest(unittest.TestCase):
+    def test_html_is_unchanged_when_turned_off(self):
+        source = (
+            "<html><head><style>p{color:red}</style></head><body><p>x</p></body></html>"
+        )
+        with mock.patch.object(email_optimizer, "EMAIL_OPTIMIZE", False):
+            self.assertEqual(optimize_html(source), source)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,72 +1,89 @@
 """ Lambda handler for the unsubscribe confirmation link """
 
 import os
-import json
-from utilities.log_config import logger
-from utilities.jinja_renderer import site_wrap, email_template
+from utilities import aws_clients, link_tokens
+from utilities.log_config import log_invocation, logger
+from utilities.metrics import metrics, record_metrics
+from utilities.jinja_renderer import (
+    EMAIL_TEMPLATE,
+    HTML_PAGE_FILE,
+    email_template,
+    prefetch_templates,
+    static_page,
+)
 from utilities.send_email import send_email
 
 
-import boto3
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource("dynamodb")
-subscribers_table = dynamodb.Table(os.environ["SUBSCRIBERS_DYNAMODB_TABLE"])
+SUBSCRIBERS_TABLE = os.environ["SUBSCRIBERS_DYNAMODB_TABLE"]
+prefetch_templates(HTML_PAGE_FILE, EMAIL_TEMPLATE)
 
 BASE_PATH = os.environ["BASE_PATH"]
 
 
+@log_invocation
+@record_metrics
 def endpoint(event, context):
-    logger.info(json.dumps(event))
-
-    if (
-        "pathParameters" in event
-        and "email" in event["pathParameters"]
-        and "identifier" in event["pathParameters"]
-    ):
-        email = event["pathParameters"]["email"]
-        identifier = event["pathParameters"]["identifier"]
-    else:
+    try:
+        email, identifier = link_tokens.link_subscriber(
+            link_tokens.UNSUBSCRIBE, event.get("pathParameters") or {}
+        )
+    except KeyError:
         logger.error(f"Incorrectly formatted unsubscribe URL...missing pathParameters")
-        return site_wrap(
+        return static_page(
             title="Incorrectly formatted unsubscribe link",
             content="<p>That link is incorrect.  Please check the unsubscribe link that it is at the bottom of each issue, or get in touch with me and I can help.</p>",
             statusCode=400,
         )
-
-    sub_query = subscribers_table.get_item(Key={"email": email})
-    logger.debug(f"DynamoDB get_item response: {sub_query}")
-    if not sub_query or "Item" not in sub_query:
-        logger.error("DynamoDB did not return the subscriber Item")
-        return site_wrap(
-            title="Subscription database error",
-            content="<p>I couldn't find your email address in the subscriber database.  This shouldn't happen if you used an 'unsubscribe' link at the bottom of a newsletter email (and you haven't previously unsubscribed).  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
-            statusCode=500,
-        )
-    subscriber = sub_query["Item"]
-
-    if identifier != subscriber["id"]:
-        logger.warning(f"ID mismatch. expected {subscriber['id']}, got {identifier}")
-        return site_wrap(
+    except link_tokens.LinkTokenError as error:
+        logger.warning(f"Rejected unsubscribe link: {error}")
+        return static_page(
             title="Problem with the unsubscribe link",
             content="<p>That link is incorrect.  Please check the unsubscribe link that it is at the bottom of each issue, or get in touch with me and I can help.</p>",
             statusCode=400,
         )
 
-    logger.info(f"Unsubscribe request: {subscriber=}")
+    # One conditional write checks the identifier and removes the subscriber.  A row
+    # suppressed for bounces or complaints is kept, so the address can't be subscribed
+    # and mailed again; it is already off the send list.
+    subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
     try:
         response = subscribers_table.delete_item(
-            Key={"email": email}, ReturnValues="ALL_OLD"
+            Key={"email": email},
+            ConditionExpression="id = :id AND attribute_not_exists(suppressed)",
+            ExpressionAttributeValues={":id": identifier},
+            ReturnValues="ALL_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
         )
     except ClientError as error:
-        if error.response["Error"]["Code"] == "ResourceNotFoundException":
-            logger.error("DynamoDB couldn't find the Subscriber to delete")
-            return site_wrap(
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        if "Item" not in error.response:
+            logger.error("DynamoDB did not return the subscriber Item")
+            return static_page(
                 title="Subscription database error",
-                content="<p>This shouldn't happen.  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
+                content="<p>I couldn't find your email address in the subscriber database.  This shouldn't happen if you used an 'unsubscribe' link at the bottom of a newsletter email (and you haven't previously unsubscribed).  The error details have been logged, and if you would kindly get in touch with me I will help you subscribe.</p>",
                 statusCode=500,
             )
-    logger.debug(f"DynamoDB delete_item response: {response}")
+        # The error carries the item in DynamoDB's typed form, {"S": "..."}
+        item = error.response["Item"]
+        if "suppressed" in item and item.get("id") in ({"S": identifier}, identifier):
+            logger.info(f"Suppressed subscriber {email} unsubscribed; keeping the row")
+            metrics.count("Unsubscribes")
+            return static_page(
+                title="Unsubscribe confirmed",
+                content="<p>Your email address has been removed.  Thank you for reading.</p>",
+            )
+        logger.warning(
+            f"ID mismatch. expected {error.response['Item'].get('id')}, got {identifier}"
+        )
+        return static_page(
+            title="Problem with the unsubscribe link",
+            content="<p>That link is incorrect.  Please check the unsubscribe link that it is at the bottom of each issue, or get in touch with me and I can help.</p>",
+            statusCode=400,
+        )
+    logger.info(f"Unsubscribed: {response.get('Attributes')=}")
 
     email_h1_header = "You've been unsubscribed from DLTJ's Thursday Threads"
     base_url = f"https://{event['requestContext']['domainName']}{BASE_PATH}"
@@ -84,9 +101,10 @@ def endpoint(event, context):
     try:
         send_email(email, email_h1_header, email_body)
     except ClientError as e:
-        logger.error("Could not send email: %", e.response["Error"]["Message"])
+        logger.error("Could not send email: %s", e.response["Error"]["Message"])
 
-    return site_wrap(
+    metrics.count("Unsubscribes")
+    return static_page(
         title="Unsubscribe confirmed",
         content="<p>Your email address has been removed.  Thank you for reading.</p>",
     )
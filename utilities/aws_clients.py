@@ -0,0 +1,141 @@
+""" Shared AWS clients and resources, created the first time they are used """
+import os
+import threading
+
+# HTTP connections each client keeps open; at least as many as the threads that share
+# a client, or they queue for a connection (botocore's default is 10)
+MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "50"))
+# "adaptive" retries with backoff and also slows the client down while it is throttled
+RETRY_MODE = os.environ.get("AWS_RETRY_MODE", "adaptive")
+# attempts per call, including the first
+MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "5"))
+# seconds to wait for a connection and for a response; well under a Lambda timeout
+CONNECT_TIMEOUT_SECONDS = 2
+READ_TIMEOUT_SECONDS = 10
+# settings that differ by service, over the shared ones
+SERVICE_SETTINGS = {
+    # longer than the 20 s an SQS long poll can wait, so an empty receive returns
+    # rather than timing out
+    "sqs": {"read_timeout": 30},
+}
+# the SES client the issue senders use
+ISSUE_SENDER = "sesv2:issue-sender"
+# settings for clients asked for by a variant name, like ISSUE_SENDER, over the
+# service's
+VARIANT_SETTINGS = {
+    # No retries and no client-side rate limiting: SesThroughput backs off when SES
+    # throttles, and a SendEmail retried after a timeout could deliver twice.  One-off
+    # emails (subscribe, confirm, unsubscribe) keep the retries.
+    ISSUE_SENDER: {"retries": {"mode": "standard", "total_max_attempts": 1}},
+}
+
+# boto3 is imported on first use: it is the largest part of a handler's init time,
+# and some code paths (the homepage, a bad request) never need it
+_clients = {}
+# re-entrant: creating a table or queue creates its service resource first
+_lock = threading.RLock()
+
+
+def _get(key, create):
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+    with _lock:
+        if key not in _clients:
+            _clients[key] = create()
+        return _clients[key]
+
+
+def _config(service_name, variant=None):
+    """
+    :param service_name: AWS service the client or resource is for
+    :param variant: name of a VARIANT_SETTINGS entry, or None
+
+    :return: botocore Config for the service's clients and resources
+    """
+    from botocore.config import Config
+
+    settings = {
+        "max_pool_connections": MAX_POOL_CONNECTIONS,
+        "retries": {"mode": RETRY_MODE, "total_max_attempts": MAX_ATTEMPTS},
+        "connect_timeout": CONNECT_TIMEOUT_SECONDS,
+        "read_timeout": READ_TIMEOUT_SECONDS,
+        # Keeps pooled connections from being dropped between sends
+        "tcp_keepalive": True,
+        **SERVICE_SETTINGS.get(service_name, {}),
+        **VARIANT_SETTINGS.get(variant, {}),
+    }
+    try:
+        return Config(**settings)
+    except TypeError:
+        # botocore releases before 1.27.84, like some bundled with Lambda runtimes,
+        # don't have the TCP keep-alive option
+        del settings["tcp_keepalive"]
+        return Config(**settings)
+
+
+def client(service_name):
+    """
+    :param service_name: AWS service, like "sqs" or "sesv2"; or a variant name like
+        ISSUE_SENDER, "<service>:<variant>", for a client of the service with its own
+        settings
+
+    :return: boto3 client, shared by every caller in the process
+    """
+
+    def create():
+        import boto3
+
+        service = service_name.partition(":")[0]
+        return boto3.client(
+            service,
+            config=_config(service, service_name if ":" in service_name else None),
+        )
+
+    return _get(("client", service_name), create)
+
+
+def resource(service_name):
+    """
+    :param service_name: AWS service with a boto3 resource interface, like "dynamodb"
+
+    :return: boto3 service resource, shared by every caller in the process
+    """
+
+    def create():
+        import boto3
+
+        return boto3.resource(service_name, config=_config(service_name))
+
+    return _get(("resource", service_name), create)
+
+
+def table(table_name):
+    """
+    :param table_name: name of a DynamoDB table
+
+    :return: boto3 DynamoDB Table resource
+    """
+    return _get(("table", table_name), lambda: resource("dynamodb").Table(table_name))
+
+
+def queue(queue_url):
+    """
+    :param queue_url: URL of an SQS queue
+
+    :return: boto3 SQS Queue resource
+    """
+    return _get(("queue", queue_url), lambda: resource("sqs").Queue(queue_url))
+
+
+def override(kind, name, stand_in):
+    """
+    Use a stand-in in place of an AWS client, for benchmarks and local runs
+
+    :param kind: "client", "resource", "table" or "queue"
+    :param name: service or variant name, table name or queue URL
+    :param stand_in: object to return instead
+    """
+    with _lock:
+        _clients[(kind, name)] = stand_in
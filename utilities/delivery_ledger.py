@@ -0,0 +1,156 @@
+""" Record of which subscribers each issue has been delivered to, so no one gets it twice """
+import concurrent.futures
+import os
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+from utilities import aws_clients
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# table keyed by issue_number and email; unset turns the ledger off
+DELIVERIES_TABLE = os.environ.get("DELIVERIES_DYNAMODB_TABLE")
+# seconds after which a claim that was never marked sent is taken to be from a sender
+# that died before calling SES; longer than any sender's timeout
+CLAIM_TIMEOUT_SECONDS = int(os.environ.get("DELIVERY_CLAIM_TIMEOUT_SECONDS", "900"))
+# days a delivery is remembered before DynamoDB's TTL removes it
+DELIVERY_RETENTION_DAYS = 30
+# ledger writes in flight at once for a bulk send
+LEDGER_WORKERS = 8
+
+CLAIMED = "claimed"
+SENT = "sent"
+
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LEDGER_WORKERS)
+
+
+def enabled():
+    """
+    :return: True if deliveries are claimed and recorded
+    """
+    return bool(DELIVERIES_TABLE)
+
+
+def claim(issue_number, email):
+    """
+    Take the delivery of an issue to a subscriber before sending it.  A claim left by a
+    sender that stopped more than CLAIM_TIMEOUT_SECONDS ago can be taken over.
+
+    :param issue_number: the issue
+    :param email: the subscriber's address
+
+    :return: CLAIMED if this sender is now the one to send it; SENT if it has already
+        been delivered; None if another sender is delivering it now
+    """
+    now = int(time.time())
+    try:
+        aws_clients.table(DELIVERIES_TABLE).put_item(
+            Item={
+                "issue_number": issue_number,
+                "email": email,
+                "deliveryStatus": CLAIMED,
+                "claimedAt": now,
+                "expiresAt": now + DELIVERY_RETENTION_DAYS * 24 * 60 * 60,
+            },
+            ConditionExpression="attribute_not_exists(email) OR (deliveryStatus = :claimed AND claimedAt < :stale)",
+            ExpressionAttributeValues={
+                ":claimed": CLAIMED,
+                ":stale": now - CLAIM_TIMEOUT_SECONDS,
+            },
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # The error carries the item in DynamoDB's typed form, {"S": "sent"}
+        if error.response.get("Item", {}).get("deliveryStatus") in ({"S": SENT}, SENT):
+            metrics.count("DuplicateDeliveries")
+            return SENT
+        return None
+    return CLAIMED
+
+
+def maybe_sent(error):
+    """
+    :param error: exception raised by an SES send call
+
+    :return: True if SES may have accepted the email anyway: the request went out and
+        no answer came back (a read timeout, a dropped connection).  Its claim should
+        be left to time out rather than released, so it isn't sent again at once.
+    """
+    # A connection that was never made means nothing was sent
+    return isinstance(error, BotoCoreError) and not isinstance(
+        error, BotoConnectionError
+    )
+
+
+def _each(function, issue_number, emails):
+    """
+    :return: list of function(issue_number, email) results, in the order of emails;
+        several are run concurrently
+    """
+    if len(emails) == 1:
+        return [function(issue_number, emails[0])]
+    return list(_pool.map(lambda email: function(issue_number, email), emails))
+
+
+def claim_many(issue_number, emails):
+    """
+    :param issue_number: the issue
+    :param emails: the subscribers' addresses
+
+    :return: list of claim() results, in the order of emails
+    """
+    return _each(claim, issue_number, emails)
+
+
+def _mark_sent(issue_number, email):
+    try:
+        aws_clients.table(DELIVERIES_TABLE).update_item(
+            Key={"issue_number": issue_number, "email": email},
+            UpdateExpression="SET deliveryStatus = :sent, sentAt = :now",
+            ExpressionAttributeValues={":sent": SENT, ":now": int(time.time())},
+        )
+    except ClientError as error:
+        # Sent but still claimed: if the message comes back after the claim times out,
+        # it is sent again
+        logger.error(
+            f"Couldn't mark the delivery of issue {issue_number} to {email} sent: {error.response['Error']['Message']}"
+        )
+
+
+def mark_sent(issue_number, emails):
+    """
+    Record deliveries SES accepted, so the messages are only acknowledged if they
+    come back
+
+    :param issue_number: the issue
+    :param emails: the subscribers' addresses
+    """
+    _each(_mark_sent, issue_number, emails)
+
+
+def _release(issue_number, email):
+    try:
+        aws_clients.table(DELIVERIES_TABLE).delete_item(
+            Key={"issue_number": issue_number, "email": email},
+            ConditionExpression="deliveryStatus = :claimed",
+            ExpressionAttributeValues={":claimed": CLAIMED},
+        )
+    except ClientError as error:
+        # It can be claimed again once CLAIM_TIMEOUT_SECONDS have passed
+        logger.warning(
+            f"Couldn't release the claim on {email} for issue {issue_number}: {error.response['Error']['Message']}"
+        )
+
+
+def release(issue_number, emails):
+    """
+    Give up claims whose send failed, so the message can be sent when it is retried
+
+    :param issue_number: the issue
+    :param emails: the subscribers' addresses
+    """
+    _each(_release, issue_number, emails)
@@ -1,12 +1,45 @@
+import concurrent.futures
+import queue
+import random
+import threading
+import time
 import typing
+import zlib
 
+from botocore.exceptions import ClientError
 
-def paginate_dynamodb_response(
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# Confirmed subscribers carry an activeShard attribute, which puts them in this sparse index
+ACTIVE_SUBSCRIBERS_INDEX = "ActiveSubscribers"
+# Number of partition key values the index is spread over.  Changing this requires
+# running the backfill_active_subscribers function again.
+ACTIVE_SUBSCRIBER_SHARDS = 10
+
+
+def active_shard(email: str) -> int:
+    """
+    :param email: subscriber's email address
+
+    :return: the subscriber's partition key value in the active subscribers index
+    """
+    return zlib.crc32(email.encode()) % ACTIVE_SUBSCRIBER_SHARDS
+
+
+def _paginate(
     dynamodb_action: typing.Callable, **kwargs
-) -> typing.Generator[dict, None, None]:
+) -> typing.Generator[list, None, None]:
+    """
+    Call a paginated DynamoDB action until it runs out of pages
+
+    :param dynamodb_action: Table.scan or Table.query
+    :param kwargs: arguments for the action
 
+    :return: generator of the list of Items in each page
+    """
     # Using the syntax from https://github.com/awsdocs/aws-doc-sdk-examples/blob/main/python/example_code/dynamodb/GettingStarted/MoviesScan.py
-    keywords = kwargs
+    keywords = dict(kwargs)
 
     done = False
     start_key = None
@@ -20,5 +53,227 @@ def paginate_dynamodb_response(
         start_key = response.get("LastEvaluatedKey", None)
         done = start_key is None
 
-        for item in response.get("Items", []):
-            yield item
+        yield response.get("Items", [])
+
+
+def paginate_concurrently(
+    dynamodb_action: typing.Callable, keyword_sets: typing.List[dict]
+) -> typing.Generator[dict, None, None]:
+    """
+    Paginate several calls of a DynamoDB action at once, one thread per call, and
+    yield the items of all of them as a single stream.  Only a few pages per thread
+    are buffered, so a slow consumer holds back the reads.
+
+    :param dynamodb_action: Table.scan or Table.query
+    :param keyword_sets: list of argument dictionaries, one per concurrent call
+
+    :return: generator of items
+    """
+    pages = queue.Queue(maxsize=2 * len(keyword_sets))
+    stop = threading.Event()
+    finished = object()
+
+    def put(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def worker(keywords):
+        try:
+            for items in _paginate(dynamodb_action, **keywords):
+                if stop.is_set():
+                    return
+                put(items)
+        except Exception as error:
+            put(error)
+        finally:
+            put(finished)
+
+    threads = [
+        threading.Thread(target=worker, args=(keywords,), daemon=True)
+        for keywords in keyword_sets
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            page = pages.get()
+            if page is finished:
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        # Release any workers still waiting to hand over a page
+        stop.set()
+
+
+def paginate_dynamodb_response(
+    dynamodb_action: typing.Callable, total_segments: int = 1, **kwargs
+) -> typing.Generator[dict, None, None]:
+    """
+    Yield every item from a paginated DynamoDB action
+
+    :param dynamodb_action: Table.scan or Table.query
+    :param total_segments: for scans, the number of segments to read in parallel
+    :param kwargs: arguments for the action, such as FilterExpression and ProjectionExpression
+
+    :return: generator of items
+    """
+    if total_segments > 1:
+        yield from paginate_concurrently(
+            dynamodb_action,
+            [
+                {**kwargs, "Segment": segment, "TotalSegments": total_segments}
+                for segment in range(total_segments)
+            ],
+        )
+        return
+
+    for items in _paginate(dynamodb_action, **kwargs):
+        yield from items
+
+
+def query_active_subscribers_page(
+    subscribers_table, shard: int, exclusive_start_key: dict = None, **kwargs
+) -> tuple:
+    """
+    Read one page of confirmed subscribers from a shard of the active subscribers index
+
+    :param subscribers_table: boto3 DynamoDB Table resource for the subscribers table
+    :param shard: the activeShard value to query
+    :param exclusive_start_key: LastEvaluatedKey of the previous page, or None to start
+    :param kwargs: extra Query arguments, such as Limit, FilterExpression and ProjectionExpression
+
+    :return: tuple of (list of subscriber items, LastEvaluatedKey or None at the end)
+    """
+    keywords = {
+        **kwargs,
+        "IndexName": ACTIVE_SUBSCRIBERS_INDEX,
+        "KeyConditionExpression": "activeShard = :shard",
+        "ExpressionAttributeValues": {
+            **kwargs.get("ExpressionAttributeValues", {}),
+            ":shard": shard,
+        },
+    }
+    if exclusive_start_key:
+        keywords["ExclusiveStartKey"] = exclusive_start_key
+    with metrics.timer("ScanPage"):
+        response = subscribers_table.query(**keywords)
+    return response.get("Items", []), response.get("LastEvaluatedKey")
+
+
+# DynamoDB error codes worth retrying after a pause
+RETRYABLE_ERRORS = {
+    "InternalServerError",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+    "TransactionConflictException",
+}
+
+
+class WriteBehindUpdater:
+    """
+    Buffer attribute-only UpdateItem calls for a table and apply them concurrently in
+    the background.  Updates whose ConditionExpression fails are skipped, so a
+    condition like "attribute_exists(email)" keeps deleted items from being recreated.
+
+    Use as a context manager; leaving the block waits for every update to finish.
+    """
+
+    def __init__(
+        self,
+        table,
+        flush_size: int = 100,
+        max_workers: int = 8,
+        max_attempts: int = 5,
+        **update_kwargs,
+    ):
+        """
+        :param table: boto3 DynamoDB Table resource
+        :param flush_size: number of buffered updates that triggers a flush
+        :param max_workers: number of UpdateItem calls in flight at once
+        :param max_attempts: number of times a throttled update is tried
+        :param update_kwargs: UpdateExpression, ConditionExpression, etc. applied to every key
+        """
+        self.table = table
+        self.flush_size = flush_size
+        self.max_attempts = max_attempts
+        self.update_kwargs = update_kwargs
+        self.stats = {"updated": 0, "skipped": 0, "failed": 0}
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, key: dict, **update_kwargs):
+        """
+        :param key: primary key of the item to update
+        :param update_kwargs: arguments for this item that replace the shared ones
+        """
+        self._buffer.append((key, update_kwargs))
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered updates to the worker threads
+        """
+        for key, update_kwargs in self._buffer:
+            future = self._executor.submit(self._update, key, update_kwargs)
+            future.add_done_callback(self._tally)
+        self._buffer = []
+
+    def close(self) -> dict:
+        """
+        Flush the buffer and wait for all updates to finish
+
+        :return: dictionary of updated/skipped/failed counts
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        return self.stats
+
+    def _update(self, key: dict, update_kwargs: dict) -> str:
+        for attempt in range(self.max_attempts):
+            try:
+                self.table.update_item(
+                    Key=key, **{**self.update_kwargs, **update_kwargs}
+                )
+                return "updated"
+            except ClientError as error:
+                code = error.response["Error"]["Code"]
+                if code == "ConditionalCheckFailedException":
+                    return "skipped"
+                if code not in RETRYABLE_ERRORS:
+                    logger.error(f"Update of {key} failed: {code}")
+                    return "failed"
+                metrics.count("DynamoDbRetries")
+            time.sleep(random.uniform(0, 0.05 * 2**attempt))
+        logger.error(
+            f"Update of {key} still throttled after {self.max_attempts} attempts"
+        )
+        return "failed"
+
+    def _tally(self, future: concurrent.futures.Future):
+        if future.exception():
+            logger.error(f"Update raised {future.exception()!r}")
+            outcome = "failed"
+        else:
+            outcome = future.result()
+        with self._lock:
+            self.stats[outcome] += 1
+        if outcome == "failed":
+            metrics.count("DynamoDbUpdateFailures")
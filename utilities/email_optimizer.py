@@ -0,0 +1,348 @@
+""" Shrink an email's HTML once, before it is copied for every recipient """
+import os
+import re
+
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# optimize issue emails before they are stored for the senders; off unless turned on
+EMAIL_OPTIMIZE = os.environ.get("EMAIL_OPTIMIZE", "false").lower() == "true"
+
+# elements whose text is kept exactly as written
+PRESERVE_WHITESPACE = {"pre", "textarea", "script", "style", "code"}
+# elements that never render whitespace between their children
+STRUCTURAL = {
+    "[document]",
+    "html",
+    "head",
+    "table",
+    "thead",
+    "tbody",
+    "tfoot",
+    "tr",
+    "ul",
+    "ol",
+}
+# elements laid out as blocks, so whitespace next to them isn't rendered
+BLOCK = STRUCTURAL | {
+    "body",
+    "div",
+    "p",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "td",
+    "th",
+    "li",
+    "blockquote",
+    "hr",
+    "meta",
+    "title",
+    "link",
+    "style",
+    "center",
+    "section",
+    "article",
+    "header",
+    "footer",
+    "figure",
+    "aside",
+    "nav",
+    "main",
+    "pre",
+    "dl",
+    "dt",
+    "dd",
+    "form",
+}
+# elements styles are never inlined into
+UNSTYLED = {"html", "head", "title", "meta", "link", "style", "script", "base"}
+
+_CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_SPACE = re.compile(r"[ \t\n\r\f]+")
+
+
+def _split(text, separator):
+    """
+    Split text on a separator that isn't in parentheses or quotes
+
+    :return: list of the stripped, non-empty parts
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == separator and not depth:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _rules(css):
+    """
+    :param css: stylesheet text
+
+    :return: list of (prelude, body) for each top-level rule; body is None for
+        statements such as @import
+    """
+    css = _CSS_COMMENT.sub("", css)
+    rules = []
+    depth = 0
+    start = 0
+    body_start = None
+    for i, char in enumerate(css):
+        if char == "{":
+            if not depth:
+                body_start = i
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if not depth:
+                rules.append((css[start:body_start].strip(), css[body_start + 1 : i]))
+                start = i + 1
+        elif char == ";" and not depth:
+            rules.append((css[start:i].strip(), None))
+            start = i + 1
+    return [(prelude, body) for prelude, body in rules if prelude]
+
+
+def _declarations(body):
+    """
+    :return: list of (property, value, important)
+    """
+    declarations = []
+    for declaration in _split(body, ";"):
+        name, colon, value = declaration.partition(":")
+        if not colon:
+            continue
+        value = value.strip()
+        important = value.lower().endswith("!important")
+        if important:
+            value = value[: -len("!important")].strip()
+        declarations.append((name.strip().lower(), value, important))
+    return declarations
+
+
+def _specificity(selector):
+    """
+    :return: tuple of (ids, classes and attributes, element names) in the selector
+    """
+    attributes = len(re.findall(r"\[[^\]]*\]", selector))
+    selector = re.sub(r"\[[^\]]*\]", " ", selector)
+    return (
+        len(re.findall(r"#[\w-]+", selector)),
+        len(re.findall(r"\.[\w-]+", selector)) + attributes,
+        len(re.findall(r"(?:^|[\s>+~])[a-zA-Z][\w-]*", selector)),
+    )
+
+
+def _minify_css(css):
+    css = _SPACE.sub(" ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def _important(css):
+    """
+    :param css: rules that stay in the stylesheet, such as those inside an @media block
+
+    :return: the rules with every declaration !important, so they still win over the
+        styles inlined into the elements, as they did before inlining
+    """
+    rules = []
+    for prelude, body in _rules(css):
+        if body is None:
+            rules.append(f"{prelude};")
+        elif prelude.startswith("@"):
+            rules.append(f"{prelude}{{{_important(body)}}}")
+        else:
+            declarations = ";".join(
+                f"{name}:{value}!important" for name, value, _ in _declarations(body)
+            )
+            rules.append(f"{prelude}{{{declarations}}}")
+    return "".join(rules)
+
+
+def _inline_styles(soup):
+    """
+    Move the stylesheet rules that apply to elements into their style attributes.
+    Rules that can't be inlined (@media, :hover...) stay in the stylesheet, made
+    !important so the inlined styles don't override them.
+
+    :param soup: BeautifulSoup document, changed in place
+
+    :return: text of the rules left in the stylesheets
+    """
+    matched = {}
+    order = 0
+    kept = []
+    for style in soup.find_all("style"):
+        for prelude, body in _rules(style.string or ""):
+            if body is None:
+                kept.append(f"{prelude};")
+                continue
+            if prelude.startswith("@media"):
+                kept.append(f"{prelude}{{{_important(body)}}}")
+                continue
+            if prelude.startswith("@"):
+                kept.append(f"{prelude}{{{body}}}")
+                continue
+            declarations = _declarations(body)
+            leftover = []
+            stateful = []
+            for selector in _split(prelude, ","):
+                # Pseudo-classes and pseudo-elements depend on state or generate content
+                if ":" in re.sub(r"\[[^\]]*\]", "", selector):
+                    stateful.append(selector)
+                    continue
+                try:
+                    elements = soup.select(selector)
+                except Exception:
+                    leftover.append(selector)
+                    continue
+                specificity = (0, *_specificity(selector))
+                for element in elements:
+                    if element.name in UNSTYLED or element.find_parent("head"):
+                        continue
+                    for name, value, important in declarations:
+                        order += 1
+                        matched.setdefault(id(element), (element, []))[1].append(
+                            (important, specificity, order, name, value)
+                        )
+            if leftover:
+                kept.append(f"{','.join(leftover)}{{{body}}}")
+            if stateful:
+                kept.append(_important(f"{','.join(stateful)}{{{body}}}"))
+        style.decompose()
+
+    # Elements with only their own style attribute have it tidied too
+    for element in soup.find_all(style=True):
+        matched.setdefault(id(element), (element, []))
+    for element, cascade in matched.values():
+        for name, value, important in _declarations(element.get("style", "")):
+            order += 1
+            cascade.append((important, (1, 0, 0, 0), order, name, value))
+        winners = {}
+        for declaration in sorted(cascade):
+            winners.pop(declaration[3], None)
+            winners[declaration[3]] = declaration
+        element["style"] = ";".join(
+            f"{name}:{value}{'!important' if important else ''}"
+            for important, _, _, name, value in winners.values()
+        )
+    return _minify_css("".join(kept))
+
+
+def _drop_unused_attributes(soup, css):
+    """
+    Remove class names and ids nothing refers to, and empty style attributes
+
+    :param soup: BeautifulSoup document, changed in place
+    :param css: text of the rules left in the stylesheets
+    """
+    classes = set(re.findall(r"\.(-?[_a-zA-Z][\w-]*)", css))
+    ids = set(re.findall(r"#(-?[_a-zA-Z][\w-]*)", css))
+    ids.update(
+        a["href"][1:] for a in soup.find_all(href=True) if a["href"].startswith("#")
+    )
+    for element in soup.find_all(True):
+        if "class" in element.attrs:
+            names = [name for name in element["class"] if name in classes]
+            if names:
+                element["class"] = names
+            else:
+                del element["class"]
+        if "id" in element.attrs and element["id"] not in ids:
+            del element["id"]
+        if "style" in element.attrs and not element["style"].strip():
+            del element["style"]
+
+
+def _strip_comments_and_whitespace(soup):
+    """
+    Remove comments, except Outlook's conditional comments, and collapse whitespace
+
+    :param soup: BeautifulSoup document, changed in place
+    """
+    from bs4 import Comment, NavigableString
+
+    for text in soup.find_all(string=True):
+        if isinstance(text, Comment):
+            if not (text.startswith("[if") or "[endif]" in text):
+                text.extract()
+            continue
+        if type(text) is not NavigableString or any(
+            parent.name in PRESERVE_WHITESPACE for parent in text.parents
+        ):
+            continue
+        collapsed = _SPACE.sub(" ", text)
+        if collapsed == " ":
+            before = text.previous_sibling
+            after = text.next_sibling
+            if text.parent.name in STRUCTURAL or (
+                getattr(before, "name", "p") in BLOCK
+                and getattr(after, "name", "p") in BLOCK
+            ):
+                text.extract()
+                continue
+        if collapsed != text:
+            text.replace_with(collapsed)
+
+
+def optimize_html(html, keep=()):
+    """
+    Inline the stylesheet, strip comments and whitespace, and drop class names and ids
+    nothing refers to.  The result renders the same and is only produced once for all
+    recipients, so every copy sent is smaller.
+
+    :param html: email HTML
+    :param keep: strings, such as placeholder tokens, that must come through unchanged;
+        if any of them doesn't, the HTML is returned as it was
+
+    :return: optimized HTML
+    """
+    if not EMAIL_OPTIMIZE:
+        return html
+    # Imported here: BeautifulSoup is slow to load and only this step needs it
+    from bs4 import BeautifulSoup
+
+    with metrics.timer("OptimizeEmail"):
+        soup = BeautifulSoup(html, features="html.parser")
+        css = _inline_styles(soup)
+        if css:
+            style = soup.new_tag("style")
+            style.string = css
+            (soup.head or soup.body or soup).insert(0, style)
+        _drop_unused_attributes(soup, css)
+        _strip_comments_and_whitespace(soup)
+        optimized = soup.decode(formatter="minimal")
+
+    if any(html.count(token) != optimized.count(token) for token in keep):
+        logger.warning(
+            "Optimizing changed the placeholder tokens; using the HTML as is"
+        )
+        return html
+    before = len(html.encode())
+    after = len(optimized.encode())
+    logger.info(
+        "Optimized email HTML from %d to %d bytes",
+        before,
+        after,
+        extra={"bytesBefore": before, "bytesAfter": after},
+    )
+    return optimized
@@ -0,0 +1,186 @@
+""" Fetch an issue's page from the blog and pull out its title and content """
+import importlib.util
+import os
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# seconds to wait for the blog to connect and to send each part of the page, and for
+# the whole page
+ISSUE_FETCH_TIMEOUT_SECONDS = float(os.environ.get("ISSUE_FETCH_TIMEOUT_SECONDS", "10"))
+# largest issue page read; anything bigger is refused rather than held in memory
+ISSUE_MAX_BYTES = int(os.environ.get("ISSUE_MAX_BYTES", str(2 * 1024 * 1024)))
+# CSS selectors for the element holding the issue, and its title and content within it
+ISSUE_CONTAINER_SELECTOR = os.environ.get("ISSUE_CONTAINER_SELECTOR", "main.h-entry")
+ISSUE_TITLE_SELECTOR = os.environ.get("ISSUE_TITLE_SELECTOR", "h1")
+ISSUE_CONTENT_SELECTOR = os.environ.get("ISSUE_CONTENT_SELECTOR", "div.e-content")
+# BeautifulSoup parser; by default lxml when it is installed, which is several times
+# faster than the pure-Python html.parser
+ISSUE_HTML_PARSER = os.environ.get("ISSUE_HTML_PARSER")
+
+READ_CHUNK_BYTES = 64 * 1024
+# pages kept for conditional GETs, by URL
+PAGE_CACHE_SIZE = 4
+
+# (ETag, Last-Modified, HTML) of recently fetched pages, by URL
+_page_cache = {}
+_page_cache_lock = threading.Lock()
+
+
+class IngestError(Exception):
+    """The issue page couldn't be fetched or didn't have the expected parts"""
+
+    def __init__(self, title, detail):
+        """
+        :param title: plain text summary, for the error page
+        :param detail: what went wrong, for the error page and the log
+        """
+        super().__init__(detail)
+        self.title = title
+        self.detail = detail
+
+
+def fetch_page(url):
+    """
+    Read a page, up to ISSUE_MAX_BYTES.  A page fetched before by this container is
+    requested with its validators, and the copy kept is used if it hasn't changed.
+
+    :param url: address of the page
+
+    :return: the page's HTML
+    """
+    request = urllib.request.Request(url)
+    with _page_cache_lock:
+        cached = _page_cache.get(url)
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            request.add_header("If-None-Match", etag)
+        if last_modified:
+            request.add_header("If-Modified-Since", last_modified)
+
+    # The socket timeout is for each connect and read; a page trickled in slowly is cut
+    # off here
+    deadline = time.monotonic() + ISSUE_FETCH_TIMEOUT_SECONDS
+    try:
+        with metrics.timer("FetchIssue"), urllib.request.urlopen(
+            request, timeout=ISSUE_FETCH_TIMEOUT_SECONDS
+        ) as response:
+            chunks = []
+            size = 0
+            while True:
+                chunk = response.read1(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if time.monotonic() > deadline:
+                    raise socket.timeout()
+                size += len(chunk)
+                if size > ISSUE_MAX_BYTES:
+                    raise IngestError(
+                        "Issue page too large",
+                        f"{url} is larger than {ISSUE_MAX_BYTES} bytes",
+                    )
+                chunks.append(chunk)
+            charset = response.headers.get_content_charset() or "utf-8"
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except urllib.error.HTTPError as error:
+        if error.code == 304 and cached:
+            logger.info(f"{url} not modified; using the copy fetched before")
+            return cached[2]
+        raise IngestError(
+            "Couldn't retrieve HTML", f"Couldn't retrieve HTML of {url}: {error}"
+        )
+    except urllib.error.URLError as error:
+        raise IngestError(
+            "Couldn't retrieve HTML",
+            f"Couldn't retrieve HTML of {url}: {error.reason}",
+        )
+    except socket.timeout:
+        raise IngestError(
+            "Couldn't retrieve HTML",
+            f"Timed out after {ISSUE_FETCH_TIMEOUT_SECONDS}s retrieving {url}",
+        )
+
+    page_html = b"".join(chunks).decode(charset, errors="replace")
+    if etag or last_modified:
+        with _page_cache_lock:
+            _page_cache.pop(url, None)
+            _page_cache[url] = (etag, last_modified, page_html)
+            while len(_page_cache) > PAGE_CACHE_SIZE:
+                del _page_cache[next(iter(_page_cache))]
+    return page_html
+
+
+def _parser():
+    if ISSUE_HTML_PARSER:
+        return ISSUE_HTML_PARSER
+    return "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+
+def _container_tag(selector):
+    """
+    :param selector: CSS selector for the element holding the issue
+
+    :return: tag name of the selector's first element, which everything it matches is
+        within; None if it doesn't start with one (".h-entry", "#post", "*") or is a
+        list of selectors
+    """
+    if "," in selector:
+        return None
+    match = re.match(r"\s*([a-zA-Z][\w-]*)", selector)
+    return match.group(1).lower() if match else None
+
+
+def extract_issue(page_html, url=""):
+    """
+    Find the issue's title and content in its page.  When the container selector starts
+    with a tag name, only those elements are parsed into a tree; the rest of the page is
+    skipped.
+
+    :param page_html: HTML of the issue's page
+    :param url: address of the page, for error messages
+
+    :return: tuple of (title text, content HTML)
+    """
+    # Imported here: BeautifulSoup is slow to load and only this step needs it
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    container_tag = _container_tag(ISSUE_CONTAINER_SELECTOR)
+    strainer = SoupStrainer(container_tag) if container_tag else None
+    with metrics.timer("ParseIssue"):
+        soup = BeautifulSoup(page_html, features=_parser(), parse_only=strainer)
+        container = soup.select_one(ISSUE_CONTAINER_SELECTOR)
+        if container is None:
+            raise IngestError(
+                "Couldn't find the issue",
+                f"Couldn't find '{ISSUE_CONTAINER_SELECTOR}' in {url}",
+            )
+        title = container.select_one(ISSUE_TITLE_SELECTOR)
+        content = container.select_one(ISSUE_CONTENT_SELECTOR)
+        if title is None or not title.get_text().strip():
+            raise IngestError(
+                "Couldn't retrieve issue_title",
+                f"Couldn't find 'issue_title' from {url}",
+            )
+        if content is None:
+            raise IngestError(
+                "Couldn't retrieve issue_content",
+                f"Couldn't find 'issue_content' from {url}",
+            )
+        return title.get_text().strip(), str(content)
+
+
+def ingest_issue(url):
+    """
+    :param url: address of the issue's page
+
+    :return: tuple of (title text, content HTML)
+    """
+    return extract_issue(fetch_page(url), url)
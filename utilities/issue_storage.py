@@ -0,0 +1,62 @@
+""" Keep an issue's email on its DynamoDB row, or in S3 when the row would be too large """
+import json
+import os
+
+from utilities import aws_clients
+from utilities.log_config import logger
+
+TEMPLATE_BUCKET = os.environ["TEMPLATE_BUCKET"]
+# largest Issues row written with the email on it; DynamoDB allows 400 KB, and the
+# fan-out job adds its state to the row afterwards
+MAX_ISSUE_ITEM_BYTES = 350 * 1024
+# parts of the stored email that move to S3 when the row would be too large
+OFFLOADED_FIELDS = ("body", "renderArgs")
+
+
+def item_bytes(item):
+    """
+    :param item: DynamoDB item
+
+    :return: a little more than the item's size as DynamoDB counts it
+    """
+    return len(json.dumps(item, default=str).encode())
+
+
+def offload_email(issue_number, issue_row):
+    """
+    Move the body of an issue email that would make its row too large to the template
+    bucket, leaving its key on the row as bodyKey
+
+    :param issue_number: the issue
+    :param issue_row: the Issues row, with the email stored by create_issue; changed
+        in place
+    """
+    size = item_bytes(issue_row)
+    if size <= MAX_ISSUE_ITEM_BYTES:
+        return
+    email = issue_row["email"]
+    key = f"issues/{issue_number}/email.json"
+    content = {field: email.pop(field) for field in OFFLOADED_FIELDS if field in email}
+    aws_clients.client("s3").put_object(
+        Bucket=TEMPLATE_BUCKET,
+        Key=key,
+        Body=json.dumps(content).encode(),
+        ContentType="application/json",
+    )
+    email["bodyKey"] = key
+    logger.info(f"Issue row would be {size} bytes; stored the email body in {key}")
+
+
+def load_email(email):
+    """
+    :param email: dictionary of email details stored with an issue
+
+    :return: the email details with the body in them, read back from S3 if it was
+        stored there
+    """
+    if "bodyKey" not in email:
+        return email
+    response = aws_clients.client("s3").get_object(
+        Bucket=TEMPLATE_BUCKET, Key=email["bodyKey"]
+    )
+    return {**email, **json.loads(response["Body"].read())}
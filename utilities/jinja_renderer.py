@@ -1,15 +1,42 @@
 """ Helper functions for rendering content through Jinja """
+import concurrent.futures
+import hashlib
 import os
-import boto3
-import jinja2
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+
+from utilities import aws_clients
+from utilities.email_optimizer import optimize_html
+from utilities.log_config import logger
+from utilities.metrics import metrics
 
 TEMPLATE_BUCKET = os.environ["TEMPLATE_BUCKET"]
+# Local directory the templates are downloaded to
+TEMPLATE_DIR = os.environ.get("TEMPLATE_DIR", "/tmp")
+# Seconds a downloaded template is used before S3 is asked whether it has changed
+TEMPLATE_TTL_SECONDS = int(os.environ.get("TEMPLATE_TTL_SECONDS", "300"))
+# Download and compile templates when a handler is loaded
+TEMPLATE_PREFETCH = os.environ.get("TEMPLATE_PREFETCH", "true").lower() == "true"
+# Compiled templates, so a runtime restarted in a warm container doesn't compile again
+BYTECODE_DIR = os.path.join(TEMPLATE_DIR, "jinja-bytecode")
+
+# Seconds browsers and CDNs may reuse a cacheable page, such as the homepage
+PAGE_MAX_AGE_SECONDS = int(os.environ.get("PAGE_MAX_AGE_SECONDS", "300"))
 
 HTML_PAGE_FILE = "site-wrapper.j2.html"
 EMAIL_TEMPLATE = "email-template.j2.html"
 
-j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath="/tmp"))
-s3 = boto3.resource("s3")
+# Time each downloaded template was last checked against S3, by template name
+_template_checked_at = {}
+_template_locks = {}
+# ETag of each downloaded template, by template name; None for one put there by hand
+_template_versions = {}
+# (template version, body, ETag) of each static page, by (title, content, statusCode)
+_static_pages = {}
+_j2_env = None
+_j2_env_lock = threading.Lock()
 
 
 def site_wrap(title, content, statusCode=200):
@@ -23,7 +50,10 @@ def site_wrap(title, content, statusCode=200):
 
     :return: AWS HTTP API Lambda Response dictionary
     """
-    response_body = _load_template(HTML_PAGE_FILE).render(title=title, content=content)
+    with metrics.timer("RenderPage"):
+        response_body = _load_template(HTML_PAGE_FILE).render(
+            title=title, content=content
+        )
     response = {
         "statusCode": statusCode,
         "headers": {"Content-type": "text/html"},
@@ -32,6 +62,61 @@ def site_wrap(title, content, statusCode=200):
     return response
 
 
+def static_page(title, content, statusCode=200, event=None, max_age=None):
+    """
+    site_wrap() for a page whose title and content never change.  It is rendered once
+    per container and version of the site template, and the response carries an ETag.
+
+    :param title: Plain text to be put in the <title> and <h1> tags
+    :param content: HTML fragment to be inserted into the template
+    :param statusCode: HTTP response status code (default=200)
+    :param event: the API Gateway request, whose If-None-Match header is checked
+    :param max_age: seconds browsers and CDNs may reuse the page; None for pages that
+        mustn't be stored, such as those from a request that changes something
+
+    :return: AWS HTTP API Lambda Response dictionary; a 304 without a body if the
+        request's If-None-Match has the page's ETag
+    """
+    _refresh_template(HTML_PAGE_FILE)
+    version = _template_versions.get(HTML_PAGE_FILE)
+    key = (title, content, statusCode)
+    page = _static_pages.get(key)
+    if page is None or page[0] != version:
+        body = site_wrap(title, content, statusCode)["body"]
+        etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"'
+        page = _static_pages[key] = (version, body, etag)
+    _, body, etag = page
+
+    # Only successful pages can be cached; an error can go away on the next request
+    cacheable = max_age is not None and statusCode == 200
+    headers = {
+        "Content-type": "text/html",
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max_age}" if cacheable else "no-store",
+    }
+    if cacheable and _if_none_match(event) & {etag, "*"}:
+        logger.debug("Page not modified: %s", etag)
+        return {"statusCode": 304, "headers": headers}
+    return {"statusCode": statusCode, "headers": headers, "body": body}
+
+
+def _if_none_match(event):
+    """
+    :param event: the API Gateway request, or None
+
+    :return: set of the ETags in the request's If-None-Match header, with weak ETags
+        made strong (the comparison is weak); "*" is returned as it is
+    """
+    headers = (event or {}).get("headers") or {}
+    # HTTP API lowercases header names; other integrations might not
+    value = next(
+        (value for name, value in headers.items() if name.lower() == "if-none-match"),
+        "",
+    )
+    tags = {tag.strip() for tag in value.split(",") if tag.strip()}
+    return {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+
+
 def email_template(
     h1_header,
     body_content,
@@ -41,20 +126,215 @@ def email_template(
     blog_version_url=None,
     unsubscribe_url=None,
 ):
-    email_body = _load_template(EMAIL_TEMPLATE).render(
-        h1_header=h1_header,
-        body_content=body_content,
-        preheader=preheader,
-        action_url=action_url,
-        action_text=action_text,
-        blog_version_url=blog_version_url,
-        unsubscribe_url=unsubscribe_url,
-    )
+    with metrics.timer("RenderEmail"):
+        email_body = _load_template(EMAIL_TEMPLATE).render(
+            h1_header=h1_header,
+            body_content=body_content,
+            preheader=preheader,
+            action_url=action_url,
+            action_text=action_text,
+            blog_version_url=blog_version_url,
+            unsubscribe_url=unsubscribe_url,
+        )
     return email_body
 
 
+class PreparedEmail:
+    """
+    An email body rendered once with placeholder tokens standing in for the
+    per-recipient fields.  Each recipient's copy is made by substituting their
+    values for the tokens, which is identical to rendering the template for them.
+    """
+
+    def __init__(self, body, placeholders, render_args, substitutable=True):
+        """
+        :param body: rendered email body containing the placeholder tokens
+        :param placeholders: dictionary of placeholder tokens keyed by field name
+        :param render_args: email_template arguments shared by every recipient
+        :param substitutable: False if each recipient's copy needs a full render
+        """
+        self.body = body
+        self.placeholders = placeholders
+        self.render_args = render_args
+        self.substitutable = substitutable
+
+    def personalize(self, **fields):
+        """
+        Produce one recipient's copy of the email body
+
+        :param fields: values for each of the per-recipient fields
+
+        :return: rendered email body
+        """
+        # An empty value could take a different branch in the template than the token did
+        if not self.substitutable or not all(fields.values()):
+            return email_template(**self.render_args, **fields)
+        body = self.body
+        for field, token in self.placeholders.items():
+            body = body.replace(token, fields[field])
+        return body
+
+    def optimize(self):
+        """
+        Shrink the body once for all recipients: inline its CSS, strip comments and
+        whitespace, and drop unused attributes.  Recipients that need a full render get
+        the template's output as it is.
+        """
+        if self.substitutable:
+            self.body = optimize_html(self.body, keep=self.placeholders.values())
+        else:
+            logger.info("Email is rendered for each recipient; not optimizing it")
+
+    def to_item(self):
+        """
+        :return: dictionary for storing the prepared email in DynamoDB
+        """
+        item = {"placeholders": self.placeholders}
+        # Only one of the two is needed to personalize, and the item size is limited
+        if self.substitutable:
+            item["body"] = self.body
+        else:
+            item["renderArgs"] = self.render_args
+        return item
+
+    @classmethod
+    def from_item(cls, item):
+        """
+        :param item: dictionary created by to_item()
+
+        :return: PreparedEmail
+        """
+        return cls(
+            item.get("body"),
+            item["placeholders"],
+            item.get("renderArgs"),
+            substitutable="renderArgs" not in item,
+        )
+
+
+def prepare_email_template(personalized=("unsubscribe_url",), **render_args):
+    """
+    Render the email template once for all recipients of a message.
+
+    The template is rendered twice with different placeholder tokens, of different
+    lengths, for the per-recipient fields.  If swapping the tokens in one rendering doesn't reproduce
+    the other, the template transforms those fields (a filter, a length test...) and
+    the returned PreparedEmail falls back to a full render for each recipient.
+
+    :param personalized: names of the email_template arguments that vary by recipient
+    :param render_args: email_template arguments shared by every recipient
+
+    :return: PreparedEmail
+    """
+    placeholders = {field: f"@@{field}:{uuid.uuid4().hex}@@" for field in personalized}
+    # Longer than the placeholders, so a template that tests a field's length renders
+    # the two differently
+    probes = {
+        field: f"@@{field}:{uuid.uuid4().hex}{uuid.uuid4().hex}@@"
+        for field in personalized
+    }
+    body = email_template(**render_args, **placeholders)
+    probe_body = email_template(**render_args, **probes)
+    for field in personalized:
+        probe_body = probe_body.replace(probes[field], placeholders[field])
+
+    return PreparedEmail(
+        body, placeholders, render_args, substitutable=probe_body == body
+    )
+
+
+def _environment():
+    """
+    :return: the Jinja environment, created on first use; senders that personalize by
+        substitution never need Jinja at all
+    """
+    global _j2_env
+    with _j2_env_lock:
+        if _j2_env is None:
+            import jinja2
+
+            os.makedirs(BYTECODE_DIR, exist_ok=True)
+            _j2_env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(searchpath=TEMPLATE_DIR),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(BYTECODE_DIR),
+            )
+        return _j2_env
+
+
 def _load_template(template):
-    local_filename = "/tmp/" + template
-    if not os.path.exists(local_filename):
-        s3.Bucket(TEMPLATE_BUCKET).download_file(template, local_filename)
-    return j2_env.get_template(template)
+    _refresh_template(template)
+    return _environment().get_template(template)
+
+
+def _refresh_template(template):
+    """
+    Make sure TEMPLATE_DIR has the current version of a template.  It is downloaded
+    the first time it is needed; after that S3 is asked every TEMPLATE_TTL_SECONDS
+    whether the ETag has changed, and the template is only downloaded again if it has.
+    A template put in TEMPLATE_DIR by hand, with no ETag file, is used as it is.
+
+    :param template: name of the template in TEMPLATE_BUCKET
+    """
+    local_filename = os.path.join(TEMPLATE_DIR, template)
+    etag_filename = f"{local_filename}.etag"
+    with _template_locks.setdefault(template, threading.Lock()):
+        checked_at = _template_checked_at.get(template)
+        if checked_at and time.monotonic() - checked_at < TEMPLATE_TTL_SECONDS:
+            return
+        etag = None
+        if os.path.exists(local_filename):
+            if not os.path.exists(etag_filename):
+                _template_versions[template] = None
+                _template_checked_at[template] = time.monotonic()
+                return
+            with open(etag_filename) as f:
+                etag = f.read()
+            _template_versions[template] = etag
+
+        try:
+            response = aws_clients.client("s3").get_object(
+                Bucket=TEMPLATE_BUCKET,
+                Key=template,
+                **({"IfNoneMatch": etag} if etag else {}),
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("304", "NotModified"):
+                logger.debug("Template %s unchanged", template)
+            elif etag:
+                logger.warning(
+                    f"Couldn't check template {template}, using the copy from {TEMPLATE_DIR}: {error.response['Error']['Message']}"
+                )
+            else:
+                raise
+        else:
+            # Replace the file in one step, so no thread can read half of it
+            with open(f"{local_filename}.download", "wb") as f:
+                f.write(response["Body"].read())
+            os.replace(f"{local_filename}.download", local_filename)
+            with open(etag_filename, "w") as f:
+                f.write(response["ETag"])
+            _template_versions[template] = response["ETag"]
+            logger.info(f"Downloaded template {template} {response['ETag']}")
+            metrics.count("TemplateDownloads")
+        _template_checked_at[template] = time.monotonic()
+
+
+def _prefetch_template(template):
+    try:
+        _load_template(template)
+    except Exception as error:
+        logger.warning(f"Couldn't prefetch template {template}: {error}")
+
+
+def prefetch_templates(*templates):
+    """
+    Download and compile a handler's templates in parallel while it is loaded, so its
+    first request doesn't wait for them.  Failures are logged; the template is tried
+    again when it is first used.  Does nothing if TEMPLATE_PREFETCH is off.
+
+    :param templates: names of the templates in TEMPLATE_BUCKET
+    """
+    if not TEMPLATE_PREFETCH or not templates:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(templates)) as executor:
+        list(executor.map(_prefetch_template, templates))
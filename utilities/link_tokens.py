@@ -0,0 +1,138 @@
+""" Signed tokens for confirm and unsubscribe links, checked without reading DynamoDB """
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# secret the tokens are signed with; unset keeps sending the {email}/{identifier} links.
+# Changing it breaks every link already sent.
+LINK_SIGNING_KEY = os.environ.get("LINK_SIGNING_KEY", "")
+# seconds a confirmation link works for; 0 for no limit.  Unsubscribe links never expire.
+CONFIRM_LINK_TTL_SECONDS = int(os.environ.get("CONFIRM_LINK_TTL_SECONDS", "604800"))
+
+CONFIRM = "confirm"
+UNSUBSCRIBE = "unsubscribe"
+
+
+class LinkTokenError(Exception):
+    """The token in a link is malformed, wrongly signed or expired"""
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signature(purpose, payload):
+    # The purpose is signed too, so a confirm link can't be used to unsubscribe
+    return hmac.new(
+        LINK_SIGNING_KEY.encode(), f"{purpose}.{payload}".encode(), hashlib.sha256
+    ).digest()
+
+
+def confirm_links_expire():
+    """
+    :return: True if the confirmation links sent expire
+    """
+    return bool(LINK_SIGNING_KEY and CONFIRM_LINK_TTL_SECONDS)
+
+
+def make_token(purpose, email, identifier, ttl_seconds=0):
+    """
+    :param purpose: CONFIRM or UNSUBSCRIBE
+    :param email: the subscriber's address
+    :param identifier: the subscriber's id
+    :param ttl_seconds: seconds the token is good for; 0 for no limit
+
+    :return: URL-safe token
+    """
+    fields = {"e": email, "i": identifier}
+    if ttl_seconds:
+        fields["x"] = int(time.time()) + ttl_seconds
+    payload = _encode(json.dumps(fields, separators=(",", ":")).encode())
+    return f"{payload}.{_encode(_signature(purpose, payload))}"
+
+
+def read_token(purpose, token):
+    """
+    :param purpose: CONFIRM or UNSUBSCRIBE
+    :param token: token from a link
+
+    :return: tuple of (email, identifier)
+    :raises LinkTokenError: if the token isn't one this stage signed for the purpose,
+        or it has expired
+    """
+    if not LINK_SIGNING_KEY:
+        raise LinkTokenError("LINK_SIGNING_KEY isn't set")
+    payload, _, signature = token.partition(".")
+    try:
+        signature = _decode(signature)
+    except ValueError:
+        raise LinkTokenError("malformed token")
+    if not hmac.compare_digest(signature, _signature(purpose, payload)):
+        raise LinkTokenError("bad signature")
+    # Signed by this stage, so the payload is one make_token() wrote
+    fields = json.loads(_decode(payload))
+    email, identifier = fields["e"], fields["i"]
+    if fields.get("x") and fields["x"] < time.time():
+        raise LinkTokenError("expired token")
+    return email, identifier
+
+
+def _link_part(purpose, email, identifier, ttl_seconds=0):
+    if not LINK_SIGNING_KEY:
+        return f"{email}/{identifier}"
+    return make_token(purpose, email, identifier, ttl_seconds)
+
+
+def confirm_url(base_url, email, identifier):
+    """
+    :param base_url: the site's URL, with the stage's BASE_PATH
+    :param email: the subscriber's address
+    :param identifier: the subscriber's id
+
+    :return: the subscriber's confirmation link
+    """
+    token = _link_part(CONFIRM, email, identifier, CONFIRM_LINK_TTL_SECONDS)
+    return f"{base_url}/subscribe/confirm/{token}"
+
+
+def unsubscribe_url(base_url, email, identifier):
+    """
+    :param base_url: the site's URL, with the stage's BASE_PATH
+    :param email: the subscriber's address
+    :param identifier: the subscriber's id
+
+    :return: the subscriber's unsubscribe link
+    """
+    return f"{base_url}/unsubscribe/{_link_part(UNSUBSCRIBE, email, identifier)}"
+
+
+def link_subscriber(purpose, path_parameters):
+    """
+    Read the subscriber from a link's path: a signed token, or the {email}/{identifier}
+    of links sent before tokens were used
+
+    :param purpose: CONFIRM or UNSUBSCRIBE
+    :param path_parameters: the API Gateway request's pathParameters
+
+    :return: tuple of (email, identifier)
+    :raises LinkTokenError: if the token is bad
+    :raises KeyError: if the path has neither
+    """
+    if "token" in path_parameters:
+        return read_token(purpose, path_parameters["token"])
+    email = path_parameters["email"]
+    identifier = path_parameters["identifier"]
+    # Counted, to tell when the old routes can be removed
+    metrics.count("LegacyLinks")
+    logger.debug("Legacy %s link for %s", purpose, email)
+    return email, identifier
@@ -1,22 +1,97 @@
+import functools
+import json
 import logging
+import os
+import random
 import sys
 
 """
 All lambda methods use this loging config.
 Provides a single place where all log config/level/formatting is setup so that one
-can see source file, line numbers, and any other desired log fields. 
+can see source file, line numbers, and any other desired log fields.
+
+Records are written to stdout as one JSON object per line.  Pass the values for a
+message as logging arguments (logger.debug("Sent %s", response)) rather than in an
+f-string, so they are only formatted when the record is emitted; keyword fields given
+with extra= become fields of the JSON object.
 """
+# level for this stage's functions: DEBUG, INFO, WARNING...
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# fraction of the per-recipient debug records (logged with extra=SAMPLED) that are kept
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+
+# extra= for records logged once per recipient
+SAMPLED = {"sampled": True}
+
+# attributes every LogRecord has; anything else on a record came from extra=
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+
+# AWS request id of the invocation in progress.  A Lambda container runs one
+# invocation at a time, so this is shared with any worker threads it starts.
+_request_id = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "location": f"{record.filename}:{record.lineno}",
+            "thread": record.threadName,
+            "requestId": _request_id,
+        }
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Keep LOG_SAMPLE_RATE of the records logged with extra=SAMPLED"""
+
+    def filter(self, record):
+        return (
+            not getattr(record, "sampled", False) or random.random() < LOG_SAMPLE_RATE
+        )
+
+
+def log_invocation(handler):
+    """
+    Decorator for Lambda handlers: tags every record logged during an invocation with
+    its AWS request id, and logs the event at DEBUG
+
+    :param handler: function taking (event, context)
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _request_id
+        _request_id = getattr(context, "aws_request_id", None)
+        logger.debug("Invoked %s", handler.__module__, extra={"event": event})
+        try:
+            return handler(event, context)
+        finally:
+            _request_id = None
+
+    return wrapper
+
+
 logger = logging.getLogger()
 for h in logger.handlers:
     logger.removeHandler(h)
 h = logging.StreamHandler(sys.stdout)
-# use whatever format you want here
-FORMAT = "%(asctime)-15s %(process)d-%(thread)d %(name)s [%(filename)s:%(lineno)d] :%(levelname)8s: %(message)s"
-h.setFormatter(logging.Formatter(FORMAT))
+h.setFormatter(JsonFormatter())
+h.addFilter(SampleFilter())
 logger.addHandler(h)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 # Suppress the more verbose modules
-logging.getLogger("__main__").setLevel(logging.DEBUG)
 logging.getLogger("botocore").setLevel(logging.WARN)
 logging.getLogger("boto3").setLevel(logging.WARN)
 logging.getLogger("s3transfer").setLevel(logging.WARN)
@@ -0,0 +1,128 @@
+""" Per-invocation timings and counts, written to stdout in CloudWatch embedded metric format """
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# CloudWatch namespace the metrics are published under
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ServerlessMailingList")
+# write the metrics at all; off for local runs that only want the handlers' work
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# most values CloudWatch accepts for one metric in one record
+MAX_VALUES_PER_RECORD = 100
+
+
+class Metrics:
+    """
+    Timings and counts for one invocation.  Timings keep every value, so CloudWatch
+    can give percentiles; counts are totals.  Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._timings = collections.defaultdict(list)
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        """
+        Time the block, in milliseconds
+
+        :param name: metric name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, (time.perf_counter() - start) * 1000)
+
+    def timing(self, name: str, milliseconds: float):
+        """
+        :param name: metric name
+        :param milliseconds: duration to record
+        """
+        with self._lock:
+            self._timings[name].append(round(milliseconds, 2))
+
+    def count(self, name: str, value: int = 1):
+        """
+        :param name: metric name
+        :param value: amount to add to the count
+        """
+        if value:
+            with self._lock:
+                self._counts[name] += value
+
+    def flush(self):
+        """
+        Write everything recorded so far to stdout and start over.  Timings with more
+        than MAX_VALUES_PER_RECORD values are spread over several records.
+        """
+        with self._lock:
+            timings, self._timings = self._timings, collections.defaultdict(list)
+            counts, self._counts = self._counts, collections.Counter()
+        if not METRICS_ENABLED:
+            return
+        offset = 0
+        while True:
+            record = {}
+            units = {}
+            for name, values in timings.items():
+                if offset < len(values):
+                    record[name] = values[offset : offset + MAX_VALUES_PER_RECORD]
+                    units[name] = "Milliseconds"
+            if not offset:
+                record.update(counts)
+                units.update({name: "Count" for name in counts})
+            if not record:
+                return
+            _write(record, units)
+            offset += MAX_VALUES_PER_RECORD
+
+
+def _write(record: dict, units: dict):
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+    document = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit} for name, unit in units.items()
+                    ],
+                }
+            ],
+        },
+        "FunctionName": function_name,
+        **record,
+    }
+    # Written directly rather than logged: CloudWatch only reads the bare JSON line
+    sys.stdout.write(json.dumps(document) + "\n")
+    sys.stdout.flush()
+
+
+# Shared by everything running in the invocation
+metrics = Metrics()
+
+
+def record_metrics(handler):
+    """
+    Decorator for Lambda handlers: writes the invocation's metrics when it returns
+
+    :param handler: function taking (event, context)
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            metrics.flush()
+
+    return wrapper
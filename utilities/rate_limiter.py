@@ -0,0 +1,67 @@
+""" Token bucket for sharing a send rate between threads """
+import threading
+import time
+
+from utilities.metrics import metrics
+
+
+class TokenBucket:
+    """
+    Tokens are added continuously at `rate` per second, up to `capacity`.  Each caller
+    takes tokens before doing rate-limited work and sleeps until enough are available.
+    Time spent sleeping is totalled in `slept_seconds`, and each wait is recorded as a
+    RateLimitSleep timing.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: tokens added per second
+        :param capacity: most tokens the bucket holds (default: one second's worth)
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.slept_seconds = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        """
+        :param rate: new number of tokens added per second
+        """
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Take tokens from the bucket, sleeping until they are available.  A request for
+        more than the capacity waits for a full bucket and leaves it in debt.
+
+        :param tokens: number of tokens needed
+
+        :return: seconds spent sleeping
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    self.slept_seconds += waited
+                    break
+                wait = (min(tokens, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.timing("RateLimitSleep", waited * 1000)
+        return waited
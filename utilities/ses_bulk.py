@@ -0,0 +1,136 @@
+""" Send an issue to many subscribers per SES call, from an SES email template """
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+from utilities import aws_clients
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# "single" sends one SendEmail per subscriber; "bulk" registers each issue as an SES
+# template and sends it with SendBulkEmail
+SES_SEND_MODE = os.environ.get("SES_SEND_MODE", "single").lower()
+# prefix of the template names, so stages sharing an account don't collide
+SES_TEMPLATE_PREFIX = os.environ.get("SES_TEMPLATE_PREFIX", "newsletter")
+# most destinations SES accepts in one SendBulkEmail call
+BULK_MAX_DESTINATIONS = 50
+# largest template SES accepts
+MAX_TEMPLATE_BYTES = 500 * 1024
+
+# SendBulkEmail entry statuses that mean the whole account has to slow down or stop,
+# as the equivalent SendEmail error for SesThroughput.on_error()
+ACCOUNT_STATUS_ERRORS = {
+    "ACCOUNT_THROTTLED": ("TooManyRequestsException", "Maximum sending rate exceeded."),
+    "ACCOUNT_DAILY_QUOTA_EXCEEDED": (
+        "LimitExceededException",
+        "Daily message quota exceeded.",
+    ),
+    "ACCOUNT_SUSPENDED": ("AccountSuspendedException", "Account suspended."),
+    "ACCOUNT_SENDING_PAUSED": ("SendingPausedException", "Account sending paused."),
+    "CONFIGURATION_SET_SENDING_PAUSED": (
+        "SendingPausedException",
+        "Configuration set sending paused.",
+    ),
+}
+
+
+def template_name(issue_number):
+    """
+    :param issue_number: the issue
+
+    :return: name of the issue's SES template
+    """
+    return f"{SES_TEMPLATE_PREFIX}-issue-{issue_number}"
+
+
+def register_issue_template(issue_number, subject, prepared):
+    """
+    Store an issue's email as an SES template, with the unsubscribe URL as its only
+    replacement field.  Issues that can't be a template (a body rendered for each
+    recipient, "{{" that SES would take for a field, too large) are left to be
+    sent one email at a time.
+
+    :param issue_number: the issue
+    :param subject: subject line of the email
+    :param prepared: PreparedEmail of the issue's body
+
+    :return: the template's name, or None if the issue wasn't registered
+    """
+    if SES_SEND_MODE != "bulk":
+        return None
+    if not prepared.substitutable:
+        logger.info("Email is rendered for each recipient; sending one at a time")
+        return None
+    if "{{" in subject or "{{" in prepared.body:
+        logger.warning("Email has text SES would read as template fields; not bulk")
+        return None
+    # Three braces: the URL goes in as it is, as it does when sent one at a time
+    html = prepared.body.replace(
+        prepared.placeholders["unsubscribe_url"], "{{{unsubscribe_url}}}"
+    )
+    if len(html.encode()) + len(subject.encode()) > MAX_TEMPLATE_BYTES:
+        logger.warning("Email is too large for an SES template; not bulk")
+        return None
+
+    name = template_name(issue_number)
+    content = {"Subject": subject, "Html": html}
+    ses = aws_clients.client("sesv2")
+    try:
+        ses.create_email_template(TemplateName=name, TemplateContent=content)
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "AlreadyExistsException":
+            raise
+        ses.update_email_template(TemplateName=name, TemplateContent=content)
+    logger.info(f"Registered SES template {name}")
+    return name
+
+
+def send_bulk(issue_email, destinations):
+    """
+    Send an issue's template to up to BULK_MAX_DESTINATIONS subscribers in one call
+
+    :param issue_email: dictionary of email details stored with the issue
+    :param destinations: list of (email address, unsubscribe URL)
+
+    :return: list of the SendBulkEmail entry results, in the order of destinations
+    """
+    with metrics.timer("SesSendBulk"):
+        response = aws_clients.client(aws_clients.ISSUE_SENDER).send_bulk_email(
+            FromEmailAddress=issue_email["fromEmailAddress"],
+            DefaultContent={
+                "Template": {
+                    "TemplateName": issue_email["templateName"],
+                    "TemplateData": json.dumps({"unsubscribe_url": ""}),
+                }
+            },
+            BulkEmailEntries=[
+                {
+                    "Destination": {"ToAddresses": [address]},
+                    "ReplacementEmailContent": {
+                        "ReplacementTemplate": {
+                            "ReplacementTemplateData": json.dumps(
+                                {"unsubscribe_url": unsubscribe_url}
+                            )
+                        }
+                    },
+                }
+                for address, unsubscribe_url in destinations
+            ],
+            ConfigurationSetName=issue_email["configurationSet"],
+        )
+    logger.debug("Bulk email sent: %s", response)
+    return response["BulkEmailEntryResults"]
+
+
+def account_error(status):
+    """
+    :param status: Status of a SendBulkEmail entry result
+
+    :return: ClientError equivalent to the status when it concerns the whole account,
+        otherwise None
+    """
+    if status not in ACCOUNT_STATUS_ERRORS:
+        return None
+    code, message = ACCOUNT_STATUS_ERRORS[status]
+    return ClientError({"Error": {"Code": code, "Message": message}}, "SendBulkEmail")
@@ -0,0 +1,176 @@
+""" Adapt the SES send rate to the account's sending quota and to throttling """
+import math
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from utilities.log_config import logger
+from utilities.metrics import metrics
+from utilities.rate_limiter import TokenBucket
+
+# lowest send rate that throttling backs off to
+MIN_RATE = 1.0
+# emails per second added to the rate after a second's worth of successful sends
+RATE_INCREASE = 1.0
+# factor the rate is multiplied by when SES throttles
+RATE_DECREASE = 0.5
+# seconds after a decrease during which further throttles don't decrease again
+DECREASE_COOLDOWN_SECONDS = 1.0
+# fraction of the 24-hour quota left unused, for one-off emails like confirmations
+DAILY_QUOTA_RESERVE = 0.02
+
+
+def classify_ses_error(error: ClientError) -> str:
+    """
+    :param error: exception raised by an SES call
+
+    :return: "throttled" when sending too fast, "quota" when the 24-hour quota is used
+        up, "paused" when the account can't send, or None for anything else
+    """
+    code = error.response["Error"]["Code"]
+    message = error.response["Error"].get("Message", "").lower()
+    if "daily message quota" in message:
+        return "quota"
+    if code in ("AccountSuspendedException", "SendingPausedException"):
+        return "paused"
+    if code in ("Throttling", "TooManyRequestsException") or "sending rate" in message:
+        return "throttled"
+    return None
+
+
+class SesThroughput:
+    """
+    Send rate control for one sender run.  The account's quota is read at start; the
+    rate starts at the configured rate, climbs by RATE_INCREASE toward the account's
+    maximum send rate while sends succeed, and is cut by RATE_DECREASE on throttling.
+    Each email is reserved from the remaining 24-hour quota, and sending stops once it
+    is gone.  Safe to use from several threads.
+    """
+
+    def __init__(self, ses_client, configured_rate: float, share: int = 1):
+        """
+        :param ses_client: boto3 SESv2 client
+        :param configured_rate: emails per second to start at
+        :param share: number of senders running at once; each gets this fraction of
+            the configured and maximum rates
+        """
+        self.max_rate = configured_rate / share
+        self.daily_remaining = math.inf
+        self.stats = {"throttles": 0, "rateIncreases": 0, "rateDecreases": 0}
+        self.stopped_reason = None
+        self._successes = 0
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+        try:
+            quota = ses_client.get_account()["SendQuota"]
+        except ClientError as error:
+            logger.warning(
+                f"Couldn't read the SES sending quota, sending at {configured_rate}/s: {error.response['Error']['Message']}"
+            )
+            quota = None
+        if quota:
+            self.max_rate = quota["MaxSendRate"] / share
+            # A negative 24-hour maximum means the account has no daily limit
+            if quota["Max24HourSend"] >= 0:
+                self.daily_remaining = (
+                    quota["Max24HourSend"] * (1 - DAILY_QUOTA_RESERVE)
+                    - quota["SentLast24Hours"]
+                ) / share
+            logger.info(
+                f"SES quota: {quota['SentLast24Hours']:.0f} of {quota['Max24HourSend']:.0f} sent in the last 24 hours, max {quota['MaxSendRate']}/s"
+            )
+
+        self.bucket = TokenBucket(min(configured_rate / share, self.max_rate))
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def stopped(self) -> bool:
+        return self.stopped_reason is not None
+
+    def reserve(self, count: int = 1) -> bool:
+        """
+        Take emails from the 24-hour quota before sending them
+
+        :param count: number of emails about to be sent
+
+        :return: False if sending has stopped or the quota doesn't allow these emails
+        """
+        with self._lock:
+            if self.stopped_reason:
+                return False
+            if self.daily_remaining < count:
+                self.stopped_reason = "daily quota reserve reached"
+                logger.warning("Stopping: the SES 24-hour quota is used up")
+                return False
+            self.daily_remaining -= count
+            return True
+
+    def release(self, count: int = 1):
+        """
+        Return reserved emails to the quota after a send that didn't happen
+
+        :param count: number of emails that weren't sent
+        """
+        with self._lock:
+            self.daily_remaining += count
+
+    def on_success(self, count: int = 1):
+        """
+        :param count: number of emails SES accepted
+        """
+        with self._lock:
+            self._successes += count
+            if self._successes < self.rate or self.rate >= self.max_rate:
+                return
+            self._successes = 0
+            new_rate = min(self.max_rate, self.rate + RATE_INCREASE)
+            self.stats["rateIncreases"] += 1
+        self.bucket.set_rate(new_rate)
+
+    def on_error(self, error: ClientError) -> str:
+        """
+        Adjust to an SES error: back off on throttling, stop on quota or paused account
+
+        :param error: exception raised by the SES call
+
+        :return: the classify_ses_error() kind of the error
+        """
+        kind = classify_ses_error(error)
+        with self._lock:
+            if kind == "throttled":
+                self.stats["throttles"] += 1
+                metrics.count("SesThrottles")
+                self._successes = 0
+                now = time.monotonic()
+                if now - self._decreased_at < DECREASE_COOLDOWN_SECONDS:
+                    return kind
+                self._decreased_at = now
+                new_rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+                self.stats["rateDecreases"] += 1
+            else:
+                if kind in ("quota", "paused") and not self.stopped_reason:
+                    self.stopped_reason = error.response["Error"]["Message"]
+                    logger.warning(f"Stopping: {self.stopped_reason}")
+                return kind
+        logger.info(f"SES throttled; send rate lowered to {new_rate:.1f}/s")
+        self.bucket.set_rate(new_rate)
+        return kind
+
+    def summary(self) -> dict:
+        """
+        :return: dictionary of throughput counters and state for logging
+        """
+        return {
+            **self.stats,
+            "finalRate": round(self.rate, 2),
+            "maxRate": self.max_rate,
+            "dailyRemaining": None
+            if self.daily_remaining == math.inf
+            else int(self.daily_remaining),
+            "stoppedReason": self.stopped_reason,
+        }
@@ -0,0 +1,291 @@
+""" Helper functions for batched SQS operations """
+import concurrent.futures
+import threading
+import time
+import typing
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from utilities.log_config import logger
+from utilities.metrics import metrics
+
+# SQS limits on a single SendMessageBatch request
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+# Seconds to wait before the first retry of failed entries; doubles on each attempt
+RETRY_BACKOFF_SECONDS = 0.2
+
+
+def _error_message(error: Exception) -> str:
+    """
+    :param error: ClientError from SQS, or a BotoCoreError such as a timeout
+
+    :return: the error's message
+    """
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Message"]
+    return str(error)
+
+
+def _batches(entries: typing.List[dict]) -> typing.Generator[list, None, None]:
+    """
+    Group SendMessageBatch entries so that each batch stays within the SQS limits
+    on number of entries and total payload size.
+
+    :param entries: list of SendMessageBatch entry dictionaries
+
+    :return: generator of lists of entries
+    """
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(entry["MessageBody"].encode())
+        if batch and (
+            len(batch) == SQS_MAX_BATCH_ENTRIES
+            or batch_bytes + entry_bytes > SQS_MAX_BATCH_BYTES
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+def _send_batch(queue, batch: typing.List[dict]) -> tuple:
+    """
+    Send one batch of messages and sort the entries by outcome
+
+    :param queue: boto3 SQS Queue resource
+    :param batch: list of SendMessageBatch entry dictionaries
+
+    :return: tuple of (Ids that were enqueued, entries to retry, entries to drop)
+    """
+    try:
+        with metrics.timer("SqsSendBatch"):
+            response = queue.send_messages(Entries=batch)
+    except ClientError as error:
+        logger.warning(
+            f"SendMessageBatch of {len(batch)} entries failed: {error.response['Error']['Message']}"
+        )
+        return [], batch, []
+
+    entries_by_id = {entry["Id"]: entry for entry in batch}
+    succeeded = [result["Id"] for result in response.get("Successful", [])]
+    retry = []
+    drop = []
+    for failure in response.get("Failed", []):
+        logger.warning(f"SendMessageBatch entry failed: {failure=}")
+        # Sender faults (bad entry, oversized message) will fail again on a retry
+        if failure.get("SenderFault"):
+            drop.append(entries_by_id[failure["Id"]])
+        else:
+            retry.append(entries_by_id[failure["Id"]])
+    return succeeded, retry, drop
+
+
+def send_message_batches(
+    queue, entries: typing.List[dict], max_workers: int = 4, max_attempts: int = 3
+) -> tuple:
+    """
+    Send messages to an SQS queue with SendMessageBatch, keeping several batches in
+    flight at once.  Only the entries that fail are retried; entries still failing
+    after max_attempts are dropped.
+
+    :param queue: boto3 SQS Queue resource
+    :param entries: list of SendMessageBatch entry dictionaries, each with a unique "Id"
+    :param max_workers: number of batches sent concurrently
+    :param max_attempts: number of times an entry is tried before it is dropped
+
+    :return: tuple of (list of Ids enqueued, dictionary of enqueued/retried/dropped counts)
+    """
+    stats = {"enqueued": 0, "retried": 0, "dropped": 0}
+    enqueued_ids = []
+    pending = list(entries)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for attempt in range(max_attempts):
+            if not pending:
+                break
+            if attempt:
+                stats["retried"] += len(pending)
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+            retry = []
+            for succeeded, failed, dropped in executor.map(
+                lambda batch: _send_batch(queue, batch), _batches(pending)
+            ):
+                enqueued_ids.extend(succeeded)
+                retry.extend(failed)
+                stats["dropped"] += len(dropped)
+            pending = retry
+
+    stats["dropped"] += len(pending)
+    stats["enqueued"] = len(enqueued_ids)
+    metrics.count("SqsRetries", stats["retried"])
+    metrics.count("SqsDropped", stats["dropped"])
+    if stats["dropped"]:
+        logger.error(
+            f"Dropped {stats['dropped']} messages after {max_attempts} attempts"
+        )
+    return enqueued_ids, stats
+
+
+class BatchAcknowledger:
+    """
+    Collect receipt handles of processed messages and delete them from the queue ten
+    at a time with DeleteMessageBatch.  Safe to call from several threads.
+    """
+
+    def __init__(self, sqs_client, queue_url: str):
+        """
+        :param sqs_client: boto3 SQS client
+        :param queue_url: URL of the queue the messages were received from
+        """
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.stats = {"deleted": 0, "failed": 0, "requests": 0}
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def ack(self, receipt_handle: str):
+        """
+        :param receipt_handle: handle of a message that has been processed
+        """
+        with self._lock:
+            self._handles.append(receipt_handle)
+            if len(self._handles) < SQS_MAX_BATCH_ENTRIES:
+                return
+            handles, self._handles = self._handles, []
+        self._delete(handles)
+
+    def flush(self) -> int:
+        """
+        Delete any messages still waiting for a full batch
+
+        :return: number of messages that were waiting
+        """
+        with self._lock:
+            handles, self._handles = self._handles, []
+        if handles:
+            self._delete(handles)
+        return len(handles)
+
+    def _delete(self, handles: typing.List[str], retry: bool = True):
+        entries = [
+            {"Id": str(index), "ReceiptHandle": handle}
+            for index, handle in enumerate(handles)
+        ]
+        try:
+            with metrics.timer("SqsDeleteBatch"):
+                response = self.sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url, Entries=entries
+                )
+            failed = [
+                handles[int(failure["Id"])] for failure in response.get("Failed", [])
+            ]
+        except (ClientError, BotoCoreError) as error:
+            logger.warning(f"DeleteMessageBatch failed: {_error_message(error)}")
+            failed = handles
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["deleted"] += len(handles) - len(failed)
+
+        if failed and retry:
+            self._delete(failed, retry=False)
+        elif failed:
+            # These messages will be received again when their visibility times out
+            logger.error(f"Couldn't delete {len(failed)} processed messages")
+            with self._lock:
+                self.stats["failed"] += len(failed)
+            metrics.count("SqsDeleteFailures", len(failed))
+
+
+class VisibilityExtender:
+    """
+    Keep messages that are still being processed invisible to other consumers by
+    extending their visibility timeout from a background thread.  Use as a context
+    manager around the processing.
+    """
+
+    def __init__(self, sqs_client, queue_url: str, visibility_timeout: int):
+        """
+        :param sqs_client: boto3 SQS client
+        :param queue_url: URL of the queue the messages were received from
+        :param visibility_timeout: seconds of visibility timeout set at receive and by each extension
+        """
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.stats = {"extended": 0, "requests": 0}
+        self._extended_at = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def track(self, receipt_handle: str):
+        """
+        :param receipt_handle: handle of a message that was just received
+        """
+        with self._lock:
+            self._extended_at[receipt_handle] = time.monotonic()
+
+    def untrack(self, receipt_handle: str):
+        """
+        :param receipt_handle: handle of a message that is no longer being processed
+        """
+        with self._lock:
+            self._extended_at.pop(receipt_handle, None)
+
+    def _run(self):
+        # Extend anything that has used half of its timeout, checking often enough
+        # that nothing gets close to the end
+        while not self._stop.wait(self.visibility_timeout / 4):
+            threshold = time.monotonic() - self.visibility_timeout / 2
+            with self._lock:
+                due = [
+                    handle
+                    for handle, extended_at in self._extended_at.items()
+                    if extended_at < threshold
+                ]
+            for offset in range(0, len(due), SQS_MAX_BATCH_ENTRIES):
+                self._extend(due[offset : offset + SQS_MAX_BATCH_ENTRIES])
+
+    def _extend(self, handles: typing.List[str]):
+        entries = [
+            {
+                "Id": str(index),
+                "ReceiptHandle": handle,
+                "VisibilityTimeout": self.visibility_timeout,
+            }
+            for index, handle in enumerate(handles)
+        ]
+        try:
+            response = self.sqs_client.change_message_visibility_batch(
+                QueueUrl=self.queue_url, Entries=entries
+            )
+        except (ClientError, BotoCoreError) as error:
+            # A timeout or dropped connection mustn't stop the thread; the messages
+            # are tried again on its next pass
+            logger.warning(
+                f"ChangeMessageVisibilityBatch failed: {_error_message(error)}"
+            )
+            return
+        failed = {int(failure["Id"]) for failure in response.get("Failed", [])}
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            for index, handle in enumerate(handles):
+                if index not in failed and handle in self._extended_at:
+                    self._extended_at[handle] = now
+                    self.stats["extended"] += 1
+        logger.debug("Extended visibility of %d messages", len(handles) - len(failed))